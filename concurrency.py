@@ -0,0 +1,126 @@
+import time
+import configparser
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+config = configparser.ConfigParser()
+config.read('conf/general_config.ini')
+
+OK = 'ok'
+THROTTLED = 'throttled'
+FAILED = 'failed'
+
+# upstream: (initial limit, max limit, target latency in seconds)
+# the max limits can be overridden in the [CONCORRENZA] section of general_config.ini
+UPSTREAMS = {
+    'wikidata_api': (4, 16, 2.0),   # search and entity info (MediaWiki API)
+    'sparql': (2, 5, 20.0),         # the query service allows 5 parallel queries per client
+    'telegram': (5, 30, 1.0),
+    'smtp': (2, 4, 5.0),
+}
+
+
+class Slot:
+    """Outcome of one request, OK unless marked otherwise."""
+
+    def __init__(self):
+        self.outcome = OK
+
+    def throttled(self) -> None:
+        self.outcome = THROTTLED
+
+    def failed(self) -> None:
+        self.outcome = FAILED
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit for one upstream. Every request holds a slot; the
+    limit grows by one for every `limit` successes faster than the target
+    latency, and is halved when the upstream throttles (429, timeouts,
+    maxlag). A burst of throttled answers from the requests already in
+    flight only halves it once per target latency.
+    """
+
+    def __init__(self, name: str, initial: int, max_limit: int, target_latency: float,
+                 min_limit: int = 1, decrease_factor: float = 0.5):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._stats = {'ok': 0, 'throttled': 0, 'failed': 0, 'decreases': 0, 'peak_limit': int(self.limit)}
+
+    def current_limit(self) -> int:
+        with self._condition:
+            return int(self.limit)
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, outcome: str = OK) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._stats[outcome] += 1
+            if outcome == THROTTLED:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.target_latency:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    self._stats['decreases'] += 1
+            elif outcome == OK and latency <= self.target_latency:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._stats['peak_limit'] = max(self._stats['peak_limit'], int(self.limit))
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self):
+        slot = Slot()
+        self.acquire()
+        start = time.monotonic()
+        try:
+            yield slot
+        except BaseException:
+            if slot.outcome == OK:
+                slot.failed()
+            raise
+        finally:
+            self.release(time.monotonic() - start, slot.outcome)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._condition:
+            return dict(self._stats, limit=round(self.limit, 1), in_flight=self.in_flight)
+
+
+_limiters = {
+    name: AdaptiveLimiter(name, initial,
+                          config.getint('CONCORRENZA', f'MAX_{name.upper()}', fallback=max_limit),
+                          target_latency)
+    for name, (initial, max_limit, target_latency) in UPSTREAMS.items()
+}
+
+
+def get_limiter(name: str) -> AdaptiveLimiter:
+    return _limiters[name]
+
+
+def slot(limiter: Optional[AdaptiveLimiter]):
+    """limiter.slot(), or a slot that limits nothing when there is no limiter."""
+    return limiter.slot() if limiter else nullcontext(Slot())
+
+
+def max_workers(*names: str) -> int:
+    """Threads needed to reach the max limit of the given upstreams together."""
+    return sum(_limiters[name].max_limit for name in names)
+
+
+def get_stats() -> Dict[str, Dict[str, float]]:
+    return {name: limiter.get_stats() for name, limiter in _limiters.items()}
@@ -3,12 +3,18 @@ import os
 import logging
 import csv
 import concurrent.futures
+import random
+import threading
+import time
+import uuid
 from typing import Optional, Tuple, Set, Dict, List, Any
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-from telegram_notification import get_global_chat_id, send_specific_telegram_notification
-from email_notification import send_email_notification
+from telegram_notification import get_global_chat_id, send_specific_telegram_parts, MAX_MESSAGE_LENGTH as TELEGRAM_MAX_MESSAGE_LENGTH
+from email_notification import send_email_batch
 from database import Database
+import concurrency
+import metrics
 
 def calculate_age(birth_date_str: Optional[str], death_date_str: Optional[str]) -> Optional[int]:
     if not birth_date_str or not death_date_str:
@@ -37,15 +43,98 @@ def execute_sql_file(db: Database, sql_file_path: str) -> None:
         logging.error(f"Error while accessing sql file: {sql_file_path}: {e}")
 
 
+def _ensure_columns(c: sqlite3.Cursor, table: str, columns: Dict[str, str]) -> None:
+    """Adds the columns missing from a table created by an older schema.sql."""
+    existing = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    for column, column_type in columns.items():
+        if column not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+def _migration_revisions(c: sqlite3.Cursor) -> None:
+    _ensure_columns(c, 'persone', {'ultima_revisione': 'INTEGER', 'ultima_modifica': 'TEXT'})
+
+
+def _migration_indexes(c: sqlite3.Cursor) -> None:
+    # persone_squadre's primary key starts with id_squadra, lookups by person need their own index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_persone_squadre_persona ON persone_squadre (id_persona, id_squadra)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_persone_squadre_da_notificare ON persone_squadre (id_persona, id_squadra) WHERE notifica_inviata = 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_persone_morte ON persone (id_persona) WHERE data_di_morte IS NOT NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifiche_storico_persona ON notifiche_storico (id_persona, id_squadra, data_invio)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifiche_storico_data ON notifiche_storico (data_invio)")
+
+
+def _migration_notification_leases(c: sqlite3.Cursor) -> None:
+    _ensure_columns(c, 'notifiche_coda', {'lease_id': 'TEXT', 'lease_scadenza': 'TIMESTAMP'})
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifiche_coda_lease ON notifiche_coda (lease_id)")
+
+
+def _migration_retry_schedule(c: sqlite3.Cursor) -> None:
+    _ensure_columns(c, 'notifiche_coda', {'prossimo_tentativo': 'TIMESTAMP'})
+    c.execute("UPDATE notifiche_coda SET prossimo_tentativo = CURRENT_TIMESTAMP WHERE prossimo_tentativo IS NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notifiche_coda_prossimo ON notifiche_coda (prossimo_tentativo)")
+
+
+def _migration_recheck_schedule(c: sqlite3.Cursor) -> None:
+    _ensure_columns(c, 'persone', {'prossimo_controllo': 'TIMESTAMP'})
+
+
+def _migration_telegram_parts(c: sqlite3.Cursor) -> None:
+    _ensure_columns(c, 'notifiche_coda', {'parti_inviate': 'INTEGER DEFAULT 0'})
+
+
+# Applied in order on top of db/schema.sql, PRAGMA user_version holds how many already ran.
+# Append only: never edit or reorder an entry that has been released.
+MIGRATIONS = [
+    _migration_revisions,
+    _migration_indexes,
+    _migration_notification_leases,
+    _migration_retry_schedule,
+    _migration_recheck_schedule,
+    _migration_telegram_parts,
+]
+
+
+def migrate_database(db: Database) -> None:
+    with db.get_cursor() as c:
+        version = c.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(f"Applying database migration {number}: {migration.__name__}")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+
+
 def create_database_and_tables(db_path: str) -> None:
     db = Database(db_path)
     try:
         execute_sql_file(db, 'db/schema.sql')
+        migrate_database(db)
         logging.info("db ok.")
     except Exception as e:
         logging.error(f"Error while creating db file: {e}")
 
 
+def check_query_plans(db_path: str) -> List[str]:
+    """
+    Runs EXPLAIN QUERY PLAN on the hot queries and returns a message for
+    every scan found: of the table or of a whole index, unless it is the
+    partial index the query is allowed to scan (see HOT_QUERIES).
+    """
+    db = Database(db_path)
+    problems = []
+    with db.get_cursor() as c:
+        for name, (sql, allowed_index) in HOT_QUERIES.items():
+            params = (None,) * sql.count('?')
+            for row in c.execute(f"EXPLAIN QUERY PLAN {sql}", params):
+                detail = row[-1]
+                if not detail.startswith('SCAN '):
+                    continue
+                if allowed_index and detail.endswith(f"INDEX {allowed_index}"):
+                    continue
+                problems.append(f"{name}: {detail}")
+    return problems
+
+
 def get_id_from_cache(db_path: str, person_name: str) -> Optional[str]:
     db = Database(db_path)
     try:
@@ -94,9 +183,150 @@ def save_id_to_cache(db_path: str, person_name: str, wikidata_id: str) -> None:
         logging.error(f"Error while writing id to database (persone table): {e}")
 
 
+def save_ids_to_cache(db_path: str, names_to_qid: Dict[str, str]) -> None:
+    """Batch version of save_id_to_cache: same merge rules, one transaction."""
+    if not names_to_qid:
+        return
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            qid_owner = {}
+            taken_names = set()
+            names = list(names_to_qid.keys())
+            qids = list(set(names_to_qid.values()))
+            for i in range(0, len(qids), 500):
+                chunk = qids[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f"SELECT id_persona, nome_originale, id_wikidata FROM persone WHERE id_wikidata IN ({placeholders})", chunk)
+                for existing_id, existing_name, qid in c.fetchall():
+                    qid_owner[qid] = (existing_id, existing_name)
+                    taken_names.add(existing_name)
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f"SELECT nome_originale FROM persone WHERE nome_originale IN ({placeholders})", chunk)
+                taken_names.update(row[0] for row in c.fetchall())
+
+            renames = []
+            upserts = []
+            for person_name, wikidata_id in names_to_qid.items():
+                owner = qid_owner.get(wikidata_id)
+                if owner is None:
+                    upserts.append((person_name, wikidata_id))
+                    qid_owner[wikidata_id] = (None, person_name)
+                    taken_names.add(person_name)
+                    continue
+
+                existing_id, existing_name = owner
+                if existing_name == person_name:
+                    continue  # Already exists/handled
+                if person_name in taken_names or existing_id is None:
+                    logging.warning(f"Race condition caught: Duplicate ID {wikidata_id} for {person_name}")
+                    continue
+                logging.warning(f"Duplicate Wikidata ID for '{person_name}': {wikidata_id} is used by '{existing_name}'. Merging '{existing_name}' -> '{person_name}'.")
+                renames.append((person_name, existing_id))
+                qid_owner[wikidata_id] = (existing_id, person_name)
+                taken_names.discard(existing_name)
+                taken_names.add(person_name)
+
+            if renames:
+                c.executemany("UPDATE persone SET nome_originale = ? WHERE id_persona = ?", renames)
+            if upserts:
+                c.executemany('''
+                    INSERT INTO persone (nome_originale, id_wikidata)
+                    VALUES (?, ?)
+                    ON CONFLICT(nome_originale) DO UPDATE SET id_wikidata=excluded.id_wikidata
+                ''', upserts)
+    except sqlite3.IntegrityError as e:
+        logging.error(f"Integrity Error while writing ids to database: {e}")
+    except Exception as e:
+        logging.error(f"Error while writing ids to database (persone table): {e}")
+
+
+class ResolutionCache:
+    """
+    Name -> Wikidata ID map, loaded with a single query and shared by the
+    search threads for a run (or for the whole life of the daemon). New
+    resolutions are kept in memory and written back in one batch by flush().
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._ids: Dict[str, str] = {}
+        self._pending: Dict[str, str] = {}
+
+    def load(self) -> None:
+        db = Database(self.db_path)
+        try:
+            with db.get_cursor() as c:
+                c.execute("SELECT nome_originale, id_wikidata FROM persone WHERE id_wikidata IS NOT NULL")
+                ids = {name: qid for name, qid in c.fetchall()}
+            with self._lock:
+                self._ids = ids
+        except Exception as e:
+            logging.error(f"Error while loading id cache from database (persone table): {e}")
+
+    def get(self, person_name: str) -> Optional[str]:
+        with self._lock:
+            return self._ids.get(person_name)
+
+    def put(self, person_name: str, wikidata_id: str) -> None:
+        with self._lock:
+            if self._ids.get(person_name) == wikidata_id:
+                return
+            self._ids[person_name] = wikidata_id
+            self._pending[person_name] = wikidata_id
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        save_ids_to_cache(self.db_path, pending)
+
+
+def get_watched_qids(db_path: str) -> Dict[str, List[str]]:
+    """Returns: dict {q_id: [original names]} for the people still alive."""
+    db = Database(db_path)
+    watched = {}
+    try:
+        with db.get_cursor() as c:
+            c.execute("SELECT id_wikidata, nome_originale FROM persone WHERE id_wikidata IS NOT NULL AND data_di_morte IS NULL")
+            for qid, name in c.fetchall():
+                watched.setdefault(qid, []).append(name)
+    except Exception as e:
+        logging.error(f"Error while reading watched people from database: {e}")
+    return watched
+
+
+def get_stored_revisions(db_path: str) -> Dict[str, int]:
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            c.execute("SELECT id_wikidata, ultima_revisione FROM persone WHERE id_wikidata IS NOT NULL AND ultima_revisione IS NOT NULL")
+            return {qid: revision for qid, revision in c.fetchall()}
+    except Exception as e:
+        logging.error(f"Error while reading revisions from database: {e}")
+        return {}
+
+
+@metrics.timed('db.save_revisions')
+def save_revisions(db_path: str, revisions: Dict[str, Tuple[int, str]]) -> None:
+    """revisions: dict {q_id: (lastrevid, modified)}"""
+    if not revisions:
+        return
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            c.executemany("UPDATE persone SET ultima_revisione = ?, ultima_modifica = ? WHERE id_wikidata = ?",
+                          [(revision, modified, qid) for qid, (revision, modified) in revisions.items()])
+    except Exception as e:
+        logging.error(f"Error while saving revisions to database: {e}")
+
+
 def get_team_data_from_files(folder: str) -> Tuple[Set[str], Dict[str, Dict[str, Any]]]:
     """
-    Format: "Nome squadra - Nome proprietario - test@email.com - 12345678 - ALL.csv"
+    Format: "Nome squadra - Nome proprietario - test@email.com - 12345678 - ALL.csv",
+    as written by the teams_downloader mirror; email, chat id (group chats are negative) and ALL are optional.
     Returns: dict {"Nome Squadra": {"owner": "...", "people": {...}, "email": "...", "chat_id": "...", "notifica_tutti": 0/1}}
     """
     all_people_names = set()
@@ -114,25 +344,27 @@ def get_team_data_from_files(folder: str) -> Tuple[Set[str], Dict[str, Dict[str,
         base_name = os.path.splitext(filename)[0]
         
         parts = [p.strip() for p in base_name.split(' - ')]
-        
-        if len(parts) < 1:
-            continue
 
-        team_name = parts[0]
-        owner_name = parts[1] if len(parts) > 1 else "N/A"
+        # email, chat id and ALL are trailing fields: a group chat id is
+        # negative and a team name may itself contain " - "
         email_notifica = None
         chat_id_notifica = None
         notifica_tutti = 0
-        
-        if len(parts) > 2:
-            for part in parts[2:]:
-                if '@' in part:
-                    email_notifica = part
-                elif part.isdigit():
-                    chat_id_notifica = part
-                elif part.upper() == 'ALL':
-                    notifica_tutti = 1
-        
+        while len(parts) > 2:
+            part = parts[-1]
+            if part.upper() == 'ALL':
+                notifica_tutti = 1
+            elif part.lstrip('-').isdigit() or part.startswith('@'):
+                chat_id_notifica = part
+            elif '@' in part:
+                email_notifica = part
+            else:
+                break
+            parts.pop()
+
+        team_name = ' - '.join(parts[:-1]) if len(parts) > 1 else parts[0]
+        owner_name = parts[-1] if len(parts) > 1 else "N/A"
+
         team_people = set()
         try:
             with open(team_csv_path, 'r', encoding='utf-8') as f:
@@ -181,91 +413,251 @@ def get_already_processed_info(db_path: str) -> Tuple[Set[str], Set[str]]:
         return set(), set()
 
 
-def associate_teams(db_path: str, team_associations: Dict[str, Dict[str, Any]], names_to_qid_map: Dict[str, str] = None) -> None:
+def get_names_due_for_recheck(db_path: str) -> Set[str]:
+    """Living people whose next check (prossimo_controllo) is reached or was never scheduled."""
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            c.execute("""
+                SELECT nome_originale FROM persone
+                WHERE data_di_morte IS NULL
+                  AND (prossimo_controllo IS NULL OR prossimo_controllo <= datetime('now'))
+            """)
+            return {row[0].strip() for row in c.fetchall()}
+    except Exception as e:
+        logging.error(f"Error while reading the people due for a recheck: {e}")
+        return set()
+
+
+# Hours between two checks of a living person by age, the first matching tier wins.
+# 0 means every run.
+RECHECK_AGE_TIERS = ((90, 0), (80, 6), (70, 24), (50, 72), (0, 168))
+RECHECK_UNKNOWN_AGE_HOURS = 24
+RECHECK_RECENT_CHANGE_DAYS = 7  # an item edited lately is checked at least every RECHECK_RECENT_CHANGE_HOURS
+RECHECK_RECENT_CHANGE_HOURS = 6
+RECHECK_HIGH_STAKE_TEAMS = 3  # people picked by this many teams are checked every run, like the very old
+
+
+def recheck_interval_hours(birth_date: Optional[str], last_modified: Optional[str], teams_count: int,
+                           now: Optional[datetime] = None) -> float:
+    if teams_count >= RECHECK_HIGH_STAKE_TEAMS:
+        return 0
+    now = now or datetime.now(timezone.utc)
+    age = calculate_age(birth_date, now.strftime('%Y-%m-%d')) if birth_date else None
+    if age is None:
+        hours = RECHECK_UNKNOWN_AGE_HOURS
+    else:
+        hours = next(tier_hours for min_age, tier_hours in RECHECK_AGE_TIERS if age >= min_age)
+
+    if last_modified:
+        try:
+            modified = datetime.fromisoformat(last_modified.replace('Z', '+00:00'))
+            if modified.tzinfo is None:
+                modified = modified.replace(tzinfo=timezone.utc)
+            if now - modified < timedelta(days=RECHECK_RECENT_CHANGE_DAYS):
+                hours = min(hours, RECHECK_RECENT_CHANGE_HOURS)
+        except ValueError:
+            pass
+    return hours
+
+
+@metrics.timed('db.schedule_rechecks')
+def schedule_rechecks(db_path: str, names: Set[str]) -> None:
+    """
+    Sets prossimo_controllo of the given (just checked) living people from
+    their age, how recently their item changed and how many teams picked
+    them. A +-10% jitter spreads the rechecks of similar people over time.
+    """
+    if not names:
+        return
+    db = Database(db_path)
+    now = datetime.now(timezone.utc)
+    try:
+        with db.get_cursor() as c:
+            c.execute("""
+                SELECT p.nome_originale, p.data_di_nascita, p.ultima_modifica, COUNT(ps.id_squadra)
+                FROM persone p LEFT JOIN persone_squadre ps ON ps.id_persona = p.id_persona
+                WHERE p.data_di_morte IS NULL
+                GROUP BY p.id_persona
+            """)
+            updates = []
+            for name, birth_date, last_modified, teams_count in c.fetchall():
+                if name not in names:
+                    continue
+                hours = recheck_interval_hours(birth_date, last_modified, teams_count, now) * random.uniform(0.9, 1.1)
+                updates.append(((now + timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S'), name))
+            c.executemany("UPDATE persone SET prossimo_controllo = ? WHERE nome_originale = ?", updates)
+    except Exception as e:
+        logging.error(f"Error while scheduling rechecks: {e}")
+
+
+def get_failed_lookups_not_due(db_path: str) -> Set[str]:
+    """Names whose last Wikidata search failed and whose backoff has not expired yet."""
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            c.execute("SELECT nome_originale FROM ricerche_fallite WHERE prossimo_tentativo > datetime('now')")
+            return {row[0] for row in c.fetchall()}
+    except Exception as e:
+        logging.error(f"Error while reading failed lookups: {e}")
+        return set()
+
+
+def record_failed_lookups(db_path: str, names: Set[str], base_hours: int = 6, max_hours: int = 720) -> Dict[str, int]:
+    """
+    Stores a failed search for each name and schedules the next attempt with an
+    exponential backoff (base_hours, 2*base_hours, ... capped at max_hours).
+    Returns: dict {name: attempts so far}
+    """
+    if not names:
+        return {}
+    db = Database(db_path)
+    attempts = {}
+    try:
+        with db.get_cursor() as c:
+            names = list(names)
+            previous = {}
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f"SELECT nome_originale, tentativi FROM ricerche_fallite WHERE nome_originale IN ({placeholders})", chunk)
+                previous.update(c.fetchall())
+
+            rows = []
+            for name in names:
+                attempts[name] = previous.get(name, 0) + 1
+                delay_hours = min(base_hours * 2 ** (attempts[name] - 1), max_hours)
+                rows.append((name, attempts[name], f"+{delay_hours} hours"))
+
+            c.executemany('''
+                INSERT INTO ricerche_fallite (nome_originale, tentativi, ultimo_tentativo, prossimo_tentativo)
+                VALUES (?, ?, datetime('now'), datetime('now', ?))
+                ON CONFLICT(nome_originale) DO UPDATE SET
+                    tentativi = excluded.tentativi,
+                    ultimo_tentativo = excluded.ultimo_tentativo,
+                    prossimo_tentativo = excluded.prossimo_tentativo
+            ''', rows)
+    except Exception as e:
+        logging.error(f"Error while saving failed lookups: {e}")
+    return attempts
+
+
+def clear_failed_lookups(db_path: str, names: Optional[Set[str]] = None) -> None:
+    """Forgets failed searches for the given names (all of them if names is None)."""
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            if names is None:
+                c.execute("DELETE FROM ricerche_fallite")
+            elif names:
+                c.executemany("DELETE FROM ricerche_fallite WHERE nome_originale = ?", [(name,) for name in names])
+    except Exception as e:
+        logging.error(f"Error while clearing failed lookups: {e}")
+
+
+@metrics.timed('db.associate_teams')
+def associate_teams(db_path: str, team_associations: Dict[str, Dict[str, Any]], names_to_qid_map: Dict[str, str] = None) -> bool:
+    """
+    Syncs squadre and persone_squadre with the roster. Teams, people (by name
+    and by QID) and current memberships are each loaded with one query and
+    diffed in memory; only the teams whose data or members changed are written.
+    Returns False if the sync failed (nothing is written then).
+    """
     db = Database(db_path)
     try:
         with db.get_cursor() as c:
             file_teams = set(team_associations.keys())
-            db_teams_rows = c.execute("SELECT id_squadra, nome_squadra FROM squadre").fetchall()
-            db_teams_map = {name: id for id, name in db_teams_rows}
+            db_teams_rows = c.execute("SELECT id_squadra, nome_squadra, nome_proprietario, email_notifica, tg_chat_id_notifica, notifica_tutti FROM squadre").fetchall()
+            db_teams_map = {row[1]: row for row in db_teams_rows}
             db_teams = set(db_teams_map.keys())
 
+            def team_values(name):
+                data = team_associations[name]
+                return (data["owner"], data["email"], data["chat_id"], data["notifica_tutti"])
+
             teams_to_add = file_teams - db_teams
             teams_to_remove = db_teams - file_teams
 
             if teams_to_add:
                 logging.info(f"Adding {len(teams_to_add)} new teams.")
-                insert_data = [
-                    (name, 
-                     team_associations[name]["owner"], 
-                     team_associations[name]["email"], 
-                     team_associations[name]["chat_id"],
-                     team_associations[name]["notifica_tutti"])
-                    for name in teams_to_add
-                ]
+                insert_data = [(name,) + team_values(name) for name in teams_to_add]
                 c.executemany("INSERT INTO squadre (nome_squadra, nome_proprietario, email_notifica, tg_chat_id_notifica, notifica_tutti) VALUES (?, ?, ?, ?, ?)",
                                 insert_data)
             
             if teams_to_remove:
                 c.executemany("DELETE FROM squadre WHERE nome_squadra = ?", [(name,) for name in teams_to_remove])
             
-            teams_to_update = file_teams & db_teams
+            teams_to_update = [name for name in file_teams & db_teams
+                               if tuple(db_teams_map[name][2:]) != team_values(name)]
             if teams_to_update:
-                update_data = [
-                    (team_associations[name]["owner"], 
-                     team_associations[name]["email"], 
-                     team_associations[name]["chat_id"], 
-                     team_associations[name]["notifica_tutti"],
-                     name)
-                    for name in teams_to_update
-                ]
+                update_data = [team_values(name) + (name,) for name in teams_to_update]
                 c.executemany("UPDATE squadre SET nome_proprietario = ?, email_notifica = ?, tg_chat_id_notifica = ?, notifica_tutti = ? WHERE nome_squadra = ?",
                                 update_data)
 
-            # Re-fetch map after updates
-            team_id_map = {row[1]: row[0] for row in c.execute("SELECT id_squadra, nome_squadra FROM squadre")}
-            person_id_map = {row[1]: row[0] for row in c.execute("SELECT id_persona, nome_originale FROM persone")}
-            
-            desired_association_ids = set()
+            if teams_to_add or teams_to_remove:
+                team_id_map = {row[1]: row[0] for row in c.execute("SELECT id_squadra, nome_squadra FROM squadre")}
+            else:
+                team_id_map = {name: row[0] for name, row in db_teams_map.items()}
+
+            person_id_map = {}
+            qid_person_id_map = {}
+            for person_id, name, qid in c.execute("SELECT id_persona, nome_originale, id_wikidata FROM persone"):
+                person_id_map[name] = person_id
+                if qid:
+                    qid_person_id_map[qid] = person_id
+
+            current_by_team = {}
+            for team_id, person_id in c.execute("SELECT id_squadra, id_persona FROM persone_squadre"):
+                current_by_team.setdefault(team_id, set()).add(person_id)
+
+            links_to_add = []
+            links_to_remove = []
+            synced_team_ids = set()
             for team_name, data in team_associations.items():
                 team_id = team_id_map.get(team_name)
                 if not team_id:
                     logging.warning(f"Team '{team_name}' not found in DB after insertion. Skipping associations.")
                     continue
+                synced_team_ids.add(team_id)
                 
+                desired = set()
                 for person_name in data["people"]:
                     person_id = person_id_map.get(person_name)
                     if person_id: 
-                        desired_association_ids.add((team_id, person_id))
+                        desired.add(person_id)
                     else:
                         # Fallback: check if we know the Wikidata ID for this name (which implies it might be a duplicate name for an existing ID)
                         if names_to_qid_map and person_name in names_to_qid_map:
                             qid = names_to_qid_map[person_name]
-                            # Find the person ID that holds this QID
-                            c.execute("SELECT id_persona FROM persone WHERE id_wikidata = ?", (qid,))
-                            row = c.fetchone()
-                            if row:
-                                existing_person_id = row[0]
-                                desired_association_ids.add((team_id, existing_person_id))
+                            existing_person_id = qid_person_id_map.get(qid)
+                            if existing_person_id:
+                                desired.add(existing_person_id)
                                 logging.info(f"Team Association: Linked '{person_name}' (via QID {qid}) to existing ID {existing_person_id}")
                             else:
                                 logging.warning(f"Warning: '{person_name}' has QID {qid} but no corresponding person found in DB.")
                         else:
                              logging.warning(f"Warning: Person '{person_name}' not found in DB and no QID mapping available.")
 
-            current_association_ids = set(c.execute("SELECT id_squadra, id_persona FROM persone_squadre"))
+                current = current_by_team.get(team_id, set())
+                if desired != current:
+                    links_to_add.extend((team_id, person_id) for person_id in desired - current)
+                    links_to_remove.extend((team_id, person_id) for person_id in current - desired)
 
-            links_to_add = desired_association_ids - current_association_ids
-            links_to_remove = current_association_ids - desired_association_ids
+            # links left behind by teams that no longer exist
+            for team_id, current in current_by_team.items():
+                if team_id not in synced_team_ids:
+                    links_to_remove.extend((team_id, person_id) for person_id in current)
 
             if links_to_add:
-                c.executemany("INSERT OR IGNORE INTO persone_squadre (id_squadra, id_persona) VALUES (?, ?)", list(links_to_add))
+                c.executemany("INSERT OR IGNORE INTO persone_squadre (id_squadra, id_persona) VALUES (?, ?)", links_to_add)
             
             if links_to_remove:
-                c.executemany("DELETE FROM persone_squadre WHERE id_squadra = ? AND id_persona = ?", list(links_to_remove))
+                c.executemany("DELETE FROM persone_squadre WHERE id_squadra = ? AND id_persona = ?", links_to_remove)
+        return True
 
     except Exception as e:
         logging.error(f"Error while processing db: {e}")
+        return False
 
 
 def insert_or_update_person(db_path: str, original_name: str, data: Dict[str, Any]) -> None:
@@ -329,166 +721,472 @@ def insert_or_update_person(db_path: str, original_name: str, data: Dict[str, An
         logging.error(f"Error while inserting data: {e}")
 
 
+@metrics.timed('db.bulk_upsert_persons')
+def bulk_upsert_persons(db_path: str, records: Dict[str, Dict[str, Any]]) -> None:
+    """
+    Same result and warnings as calling insert_or_update_person for every
+    (original name, data) pair in order, merges by id_wikidata included, but
+    the merge logic runs in memory and everything is written in one transaction.
+    """
+    if not records:
+        return
+    db = Database(db_path)
+    try:
+        with db.get_cursor() as c:
+            id_by_name, name_by_id, qid_by_id, id_by_qid = {}, {}, {}, {}
+            for person_id, name, qid in c.execute("SELECT id_persona, nome_originale, id_wikidata FROM persone"):
+                id_by_name[name] = person_id
+                name_by_id[person_id] = name
+                qid_by_id[person_id] = qid
+                if qid:
+                    id_by_qid[qid] = person_id
+
+            # final state of every row touched, keyed by id_persona (negative for new rows)
+            touched = {}
+            merged_ids = set()
+            for original_name, data in records.items():
+                new_data = {
+                    'nome': data.get('nome', 'Non trovato'),
+                    'data_di_nascita': data.get('data_di_nascita'),
+                    'data_di_morte': data.get('data_di_morte'),
+                    'wikidata_url': data.get('wikidata_url', 'Non trovato'),
+                    'id_wikidata': data.get('id_wikidata', None)
+                }
+                existing_id = id_by_name.get(original_name)
+                qid = new_data['id_wikidata']
+
+                holder_id = id_by_qid.get(qid) if qid else None
+                if holder_id is not None and holder_id != existing_id:
+                    if existing_id is not None:
+                        # renaming the holder would clash with the row already named original_name
+                        logging.error(f"Integrity Error while inserting data for {original_name}: UNIQUE constraint failed: persone.nome_originale")
+                        continue
+                    holder_name = name_by_id[holder_id]
+                    logging.warning(f"Duplicate Wikidata ID for '{original_name}': {qid} is used by '{holder_name}'. Merging '{holder_name}' -> '{original_name}'.")
+                    del id_by_name[holder_name]
+                    id_by_name[original_name] = holder_id
+                    name_by_id[holder_id] = original_name
+                    touched[holder_id] = dict(new_data, nome_originale=original_name)
+                    if holder_id > 0:
+                        merged_ids.add(holder_id)
+                    logging.warning(f"Merge successful: ID {holder_id} fully updated to '{original_name}'")
+                    continue
+
+                if existing_id is None:
+                    existing_id = -(len(touched) + 1)
+                    id_by_name[original_name] = existing_id
+                    name_by_id[existing_id] = original_name
+                old_qid = qid_by_id.get(existing_id)
+                if old_qid and id_by_qid.get(old_qid) == existing_id:
+                    del id_by_qid[old_qid]
+                if qid:
+                    id_by_qid[qid] = existing_id
+                qid_by_id[existing_id] = qid
+                touched[existing_id] = dict(new_data, nome_originale=original_name)
+
+            def values(row):
+                return (row['nome_originale'], row['nome'], row['data_di_nascita'], row['data_di_morte'],
+                        row['wikidata_url'], row['id_wikidata'])
+
+            merges = [values(row) + (person_id,) for person_id, row in touched.items() if person_id in merged_ids]
+            upserts = [values(row) for person_id, row in touched.items() if person_id not in merged_ids]
+
+            if merges:
+                c.executemany('''
+                    UPDATE persone
+                    SET nome_originale = ?, nome_wikidata = ?, data_di_nascita = ?, data_di_morte = ?,
+                        link_wikidata = ?, id_wikidata = ?
+                    WHERE id_persona = ?
+                ''', merges)
+            if upserts:
+                c.executemany('''
+                    INSERT INTO persone (nome_originale, nome_wikidata, data_di_nascita, data_di_morte, link_wikidata, id_wikidata)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(nome_originale) DO UPDATE SET
+                        nome_wikidata = excluded.nome_wikidata,
+                        data_di_nascita = excluded.data_di_nascita,
+                        data_di_morte = excluded.data_di_morte,
+                        link_wikidata = excluded.link_wikidata,
+                        id_wikidata = excluded.id_wikidata
+                ''', upserts)
+
+    except sqlite3.IntegrityError as e:
+        # ordering corner cases (e.g. two rows swapping ids): redo them one at a time
+        logging.warning(f"Bulk update of {len(records)} people failed ({e}), falling back to single updates")
+        for original_name, data in records.items():
+            insert_or_update_person(db_path, original_name, data)
+
+    except Exception as e:
+        logging.error(f"Error while inserting data: {e}")
+
+
+SQL_GLOBAL_TO_NOTIFY = '''
+    SELECT P.id_persona, P.nome_originale, P.data_di_nascita, P.data_di_morte, P.link_wikidata
+    FROM persone P
+    LEFT JOIN notifiche_globali NG ON P.id_persona = NG.id_persona
+    WHERE P.data_di_morte IS NOT NULL AND (NG.inviata IS NULL OR NG.inviata = 0)
+'''
+
+SQL_TEAM_NOTIFICATIONS = '''
+    SELECT P.id_persona, P.nome_originale, P.data_di_nascita, P.data_di_morte, P.link_wikidata,
+           S.id_squadra, S.nome_squadra, S.email_notifica, S.tg_chat_id_notifica
+    FROM persone P
+    JOIN persone_squadre PS ON P.id_persona = PS.id_persona
+    JOIN squadre S ON PS.id_squadra = S.id_squadra
+    WHERE P.data_di_morte IS NOT NULL AND PS.notifica_inviata = 0
+'''
+
+# formatted with one placeholder per id_persona, at most SQL_IN_CHUNK_SIZE at a time
+SQL_TEAMS_OF_PEOPLE = '''
+    SELECT PS.id_persona, S.nome_squadra
+    FROM persone_squadre PS
+    JOIN squadre S ON PS.id_squadra = S.id_squadra
+    WHERE PS.id_persona IN ({placeholders})
+    ORDER BY S.nome_squadra
+'''
+SQL_IN_CHUNK_SIZE = 500
+
+SQL_DUE_JOBS = '''
+    SELECT id_coda FROM notifiche_coda
+    WHERE prossimo_tentativo <= datetime('now')
+      AND (lease_scadenza IS NULL OR lease_scadenza <= datetime('now'))
+    ORDER BY prossimo_tentativo LIMIT ?
+'''
+
+SQL_LEASED_JOBS = '''
+    SELECT id_coda, tipo, indirizzo, oggetto, corpo, id_squadra, id_persona, tentativi, COALESCE(parti_inviate, 0)
+    FROM notifiche_coda WHERE lease_id = ?
+'''
+
+# The queries run by every queue and dispatch pass, see check_query_plans:
+# name -> (sql, partial index it may scan). Scanning a partial index only
+# visits the rows it was built for (dead people, links not notified yet),
+# any other scan is reported.
+HOT_QUERIES = {
+    'global notifications to queue': (SQL_GLOBAL_TO_NOTIFY, 'idx_persone_morte'),
+    'team notifications to queue': (SQL_TEAM_NOTIFICATIONS, 'idx_persone_squadre_da_notificare'),
+    'teams of the people to notify': (SQL_TEAMS_OF_PEOPLE.format(placeholders='?'), None),
+    'due notification jobs': (SQL_DUE_JOBS, None),
+    'leased notification jobs': (SQL_LEASED_JOBS, None),
+}
+
+
+def _render_necrology(original_name: str, birth_date: Optional[str], death_date: Optional[str],
+                      wikidata_url: Optional[str], teams_str: str) -> str:
+    age = calculate_age(birth_date, death_date)
+    age_text = f"({age} anni)" if age is not None else ""
+    return (
+        f"NECROLOGIO FANTAMORTO\n=================================\n\n"
+        f"† *{original_name.upper()}* †\n\n"
+        f"Data di nascita: {birth_date}\n"
+        f"Data di morte: {death_date} {age_text}\n"
+        f"Link Wikidata:\n{wikidata_url}\n"
+        f"---------------------------------\n\n"
+        f"Squadre: {teams_str}"
+    )
+
+
+@metrics.timed('db.queue_new_death_notifications')
 def queue_new_death_notifications(db_path: str) -> None:
     db = Database(db_path)
     GLOBAL_ADMIN_CHAT_ID = get_global_chat_id()
+    INSERT_QUEUE = "INSERT INTO notifiche_coda (tipo, indirizzo, oggetto, corpo, id_squadra, id_persona, prossimo_tentativo) VALUES (?, ?, ?, ?, ?, ?, datetime('now'))"
     
     try:
         with db.get_cursor() as c:
-            # Global Notifications
-            c.execute('''
-                SELECT P.id_persona, P.nome_originale, P.data_di_nascita, P.data_di_morte, P.link_wikidata 
-                FROM persone P
-                LEFT JOIN notifiche_globali NG ON P.id_persona = NG.id_persona
-                WHERE P.data_di_morte IS NOT NULL AND (NG.inviata IS NULL OR NG.inviata = 0)
-            ''')
+            c.execute(SQL_GLOBAL_TO_NOTIFY)
             global_to_notify = c.fetchall()
-            
+
+            c.execute(SQL_TEAM_NOTIFICATIONS)
+            team_notifications = c.fetchall()
+
+            if not global_to_notify and not team_notifications:
+                return
+
+            # teams of the people being queued with one query per chunk, and one necrology per person
+            teams_by_person = {}
+            person_ids = list({row[0] for row in global_to_notify} | {row[0] for row in team_notifications})
+            for i in range(0, len(person_ids), SQL_IN_CHUNK_SIZE):
+                chunk = person_ids[i:i + SQL_IN_CHUNK_SIZE]
+                c.execute(SQL_TEAMS_OF_PEOPLE.format(placeholders=','.join('?' * len(chunk))), chunk)
+                for person_id, team_name in c.fetchall():
+                    teams_by_person.setdefault(person_id, []).append(team_name)
+
+            necrologies = {}
+
+            def necrology(person_id, original_name, birth_date, death_date, wikidata_url):
+                if person_id not in necrologies:
+                    teams = teams_by_person.get(person_id)
+                    teams_str = ', '.join(teams) if teams else 'N/A'
+                    necrologies[person_id] = _render_necrology(original_name, birth_date, death_date, wikidata_url, teams_str)
+                return necrologies[person_id]
+
+            queue_rows = []
+
+            # Global Notifications
             if global_to_notify:
                 c.execute("SELECT id_squadra, nome_squadra, email_notifica, tg_chat_id_notifica FROM squadre WHERE notifica_tutti = 1")
                 general_subscribers = c.fetchall()
                 
                 for (person_id, original_name, birth_date, death_date, wikidata_url) in global_to_notify:
-                    age = calculate_age(birth_date, death_date)
-                    age_text = f"({age} anni)" if age is not None else ""
-                    
-                    c.execute("SELECT T2.nome_squadra FROM persone_squadre AS T1 JOIN squadre AS T2 ON T1.id_squadra = T2.id_squadra WHERE T1.id_persona = ?", (person_id,))
-                    teams_of_dead_person = {row[0] for row in c.fetchall()}
-                    teams_str = ', '.join(teams_of_dead_person) if teams_of_dead_person else 'N/A'
-
-                    base_msg = (
-                        f"NECROLOGIO FANTAMORTO\n=================================\n\n"
-                        f"† *{original_name.upper()}* †\n\n"
-                        f"Data di nascita: {birth_date}\n"
-                        f"Data di morte: {death_date} {age_text}\n"
-                        f"Link Wikidata:\n{wikidata_url}\n"
-                        f"---------------------------------\n\n"
-                        f"Squadre: {teams_str}"
-                    )
+                    base_msg = necrology(person_id, original_name, birth_date, death_date, wikidata_url)
                     
                     if GLOBAL_ADMIN_CHAT_ID:
                         admin_msg = "*FANTAMORTO (ADMIN)*\n\n" + base_msg
-                        c.execute("INSERT INTO notifiche_coda (tipo, indirizzo, corpo, id_persona) VALUES ('telegram', ?, ?, ?)", (GLOBAL_ADMIN_CHAT_ID, admin_msg, person_id))
+                        queue_rows.append(('telegram', GLOBAL_ADMIN_CHAT_ID, None, admin_msg, None, person_id))
                     
+                    sub_msg = f"*NOTIFICA GENERALE*\n" + base_msg
+                    subject = f"†FantaMorto† Notifica Generale: {original_name}"
                     for (id_squadra, nome_squadra, email, chat_id) in general_subscribers:
-                        sub_msg = f"*NOTIFICA GENERALE*\n" + base_msg
                         if email:
-                            subject = f"†FantaMorto† Notifica Generale: {original_name}"
-                            c.execute("INSERT INTO notifiche_coda (tipo, indirizzo, oggetto, corpo, id_squadra, id_persona) VALUES ('email', ?, ?, ?, ?, ?)", (email, subject, sub_msg, id_squadra, person_id))
+                            queue_rows.append(('email', email, subject, sub_msg, id_squadra, person_id))
                         if chat_id:
-                            c.execute("INSERT INTO notifiche_coda (tipo, indirizzo, corpo, id_squadra, id_persona) VALUES ('telegram', ?, ?, ?, ?)", (chat_id, sub_msg, id_squadra, person_id))
-                    
-                    c.execute("INSERT OR REPLACE INTO notifiche_globali (id_persona, inviata) VALUES (?, 1)", (person_id,))
+                            queue_rows.append(('telegram', chat_id, None, sub_msg, id_squadra, person_id))
+                
+                c.executemany("INSERT OR REPLACE INTO notifiche_globali (id_persona, inviata) VALUES (?, 1)",
+                              [(row[0],) for row in global_to_notify])
             
             # Team Specific Notifications
-            c.execute('''
-                SELECT P.id_persona, P.nome_originale, P.data_di_nascita, P.data_di_morte, P.link_wikidata,
-                       S.id_squadra, S.nome_squadra, S.email_notifica, S.tg_chat_id_notifica
-                FROM persone P
-                JOIN persone_squadre PS ON P.id_persona = PS.id_persona
-                JOIN squadre S ON PS.id_squadra = S.id_squadra
-                WHERE P.data_di_morte IS NOT NULL AND PS.notifica_inviata = 0
-            ''')
-            team_notifications = c.fetchall()
-            
             for (person_id, original_name, birth_date, death_date, wikidata_url, team_id, team_name, email, chat_id) in team_notifications:
-                age = calculate_age(birth_date, death_date)
-                age_text = f"({age} anni)" if age is not None else ""
-                
-                c.execute("SELECT T2.nome_squadra FROM persone_squadre AS T1 JOIN squadre AS T2 ON T1.id_squadra = T2.id_squadra WHERE T1.id_persona = ?", (person_id,))
-                all_teams = {row[0] for row in c.fetchall()}
-                teams_str = ', '.join(all_teams) if all_teams else 'N/A'
-
-                base_msg = (
-                    f"NECROLOGIO FANTAMORTO\n=================================\n\n"
-                    f"† *{original_name.upper()}* †\n\n"
-                    f"Data di nascita: {birth_date}\n"
-                    f"Data di morte: {death_date} {age_text}\n"
-                    f"Link Wikidata:\n{wikidata_url}\n"
-                    f"---------------------------------\n\n"
-                    f"Squadre: {teams_str}"
-                )
-                
+                base_msg = necrology(person_id, original_name, birth_date, death_date, wikidata_url)
                 team_msg = f"*FANTAMORTO*\n\n Squadra: {team_name}\n\n" + base_msg
                 email_subject = f"†FantaMorto† Notifica: Decesso - {original_name}"
 
                 if email:
-                    c.execute("INSERT INTO notifiche_coda (tipo, indirizzo, oggetto, corpo, id_squadra, id_persona) VALUES ('email', ?, ?, ?, ?, ?)", (email, email_subject, team_msg, team_id, person_id))
+                    queue_rows.append(('email', email, email_subject, team_msg, team_id, person_id))
                 
                 if chat_id:
-                    c.execute("INSERT INTO notifiche_coda (tipo, indirizzo, corpo, id_squadra, id_persona) VALUES ('telegram', ?, ?, ?, ?)", (chat_id, team_msg, team_id, person_id))
+                    queue_rows.append(('telegram', chat_id, None, team_msg, team_id, person_id))
                 
-                c.execute("UPDATE persone_squadre SET notifica_inviata = 1 WHERE id_squadra = ? AND id_persona = ?", (team_id, person_id))
+            if queue_rows:
+                c.executemany(INSERT_QUEUE, queue_rows)
+            if team_notifications:
+                c.executemany("UPDATE persone_squadre SET notifica_inviata = 1 WHERE id_squadra = ? AND id_persona = ?",
+                              [(row[5], row[0]) for row in team_notifications])
 
     except Exception as e:
         logging.error(f"Error while queueing notifications: {e}")
 
 
-def _process_queue_job(job: Tuple) -> Tuple[int, bool]:
-    (id_coda, tipo, indirizzo, oggetto, corpo) = job
-    
-    success = False
-    if tipo == 'email':
-        success = send_email_notification(indirizzo, oggetto, corpo)
-    elif tipo == 'telegram':
-        success = send_specific_telegram_notification(indirizzo, corpo)
-        
-    return id_coda, success
+def _process_queue_job(job: Tuple) -> Tuple[int, bool, int]:
+    """Sends one Telegram job, emails always go in batches through _process_queue_jobs. Returns: (id, success, parts sent so far)"""
+    (id_coda, _, indirizzo, _, corpo, parti_inviate) = job
+    parti_inviate, parts = send_specific_telegram_parts(indirizzo, corpo, parti_inviate)
+    return id_coda, parti_inviate == parts, parti_inviate
+
+
+def _process_queue_jobs(jobs: List[Tuple]) -> List[Tuple[bool, int]]:
+    """Sends the jobs of one channel, emails as a single batch on one SMTP session. Returns: [(success, parts sent)]"""
+    if jobs[0][1] == 'email':
+        successes = send_email_batch([(indirizzo, oggetto, corpo) for (_, _, indirizzo, oggetto, corpo, _) in jobs])
+        return [(success, 0) for success in successes]
+    return [_process_queue_job(job)[1:] for job in jobs]
+
+
+COALESCE_SEPARATOR = "\n\n\n"
+
+
+def coalesce_jobs(jobs: List[Tuple]) -> List[Tuple[Tuple, List[Tuple]]]:
+    """
+    Groups the jobs by recipient into one message, Telegram ones up to 4096 characters.
+    Returns: [((id of the first job, tipo, indirizzo, oggetto, corpo, parts already sent), [original jobs]), ...]
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault((job[1], job[2]), []).append(job)
+
+    deliveries = []
+    for (tipo, indirizzo), group in groups.items():
+        if len(group) == 1:
+            deliveries.append((group[0][:5] + (group[0][8],), group))
+            continue
+
+        # identical bodies (e.g. the same message queued twice) are sent once
+        bodies = {}
+        for job in group:
+            bodies.setdefault(job[4], []).append(job)
+
+        if tipo == 'telegram':
+            parts = []
+            for body, body_jobs in bodies.items():
+                # the same body went to the same chat, its parts already sent count for every job
+                parts_sent = max(job[8] for job in body_jobs)
+                if parts_sent:
+                    deliveries.append(((body_jobs[0][0], tipo, indirizzo, body_jobs[0][3], body, parts_sent), body_jobs))
+                elif parts and len(parts[-1][0]) + len(COALESCE_SEPARATOR) + len(body) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                    parts[-1] = (parts[-1][0] + COALESCE_SEPARATOR + body, parts[-1][1] + body_jobs)
+                else:
+                    parts.append((body, list(body_jobs)))
+            for body, part_jobs in parts:
+                deliveries.append(((part_jobs[0][0], tipo, indirizzo, part_jobs[0][3], body, 0), part_jobs))
+        else:
+            subjects = {job[3] for job in group}
+            subject = subjects.pop() if len(subjects) == 1 else f"†FantaMorto† {len(bodies)} notifiche"
+            deliveries.append(((group[0][0], tipo, indirizzo, subject, COALESCE_SEPARATOR.join(bodies), 0), group))
+
+    return deliveries
 
 
-def send_queued_notifications(db_path: str, MAX_WORKERS: int = 5) -> None:
+def _split_email_batches(jobs: List, size: int) -> List[List]:
+    """Splits the email jobs in send_email_batch calls of at most `size` messages (one pooled session each)."""
+    return [jobs[i:i + size] for i in range(0, len(jobs), size)]
+
+
+NOTIFICATION_LEASE_SECONDS = 300
+LEASE_RENEW_SECONDS = NOTIFICATION_LEASE_SECONDS // 3  # renewed well before it expires while sends are running
+NOTIFICATION_DEFAULT_MAX_RETRIES = 5  # same value as the shipped [NOTIFICHE] section
+NOTIFICATION_MAX_RETRIES = {'email': NOTIFICATION_DEFAULT_MAX_RETRIES, 'telegram': NOTIFICATION_DEFAULT_MAX_RETRIES}
+NOTIFICATION_RETRY_BASE_SECONDS = 300
+NOTIFICATION_RETRY_MAX_SECONDS = 6 * 3600
+ACK_BATCH_SIZE = 10
+EMAIL_BATCH_SIZE = ACK_BATCH_SIZE  # a batch is acknowledged as soon as its session is done with it
+CLAIM_BATCH_SIZE = 200  # large enough for the jobs of one recipient to be coalesced together
+
+
+@metrics.timed('db.claim_notification_jobs')
+def claim_notification_jobs(db_path: str, limit: int, lease_seconds: int = NOTIFICATION_LEASE_SECONDS) -> Tuple[str, List[Tuple]]:
+    """
+    Leases up to `limit` due jobs (prossimo_tentativo reached) that are not
+    held by another dispatcher and commits right away. A job whose lease
+    expires because its dispatcher crashed can be claimed again.
+    Returns: (lease token, [(id, tipo, addr, subj, body, id_squadra, id_persona, attempts, telegram parts sent)])
+    """
     db = Database(db_path)
-    MAX_RETRIES = 5
-    
-    try:
-        with db.get_cursor() as c:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                # job is now (id, tipo, addr, subj, body, id_squadra, id_persona, attempts)
-                # fetch all columns, pass first 5 to processor
-                c.execute("SELECT id_coda, tipo, indirizzo, oggetto, corpo, id_squadra, id_persona, tentativi FROM notifiche_coda")
-                jobs = c.fetchall()
+    token = uuid.uuid4().hex
+    with db.get_cursor() as c:
+        c.execute(f'''
+            UPDATE notifiche_coda SET lease_id = ?, lease_scadenza = datetime('now', ?)
+            WHERE id_coda IN ({SQL_DUE_JOBS})
+        ''', (token, f"+{lease_seconds} seconds", limit))
+        c.execute(SQL_LEASED_JOBS, (token,))
+        return token, c.fetchall()
 
-                jobs_to_delete = []
-                jobs_to_update_retry = []
-                history_entries = []
 
-                if not jobs:
-                    return
+@metrics.timed('db.extend_notification_lease')
+def extend_notification_lease(db_path: str, token: str, lease_seconds: int = NOTIFICATION_LEASE_SECONDS) -> int:
+    """Pushes back the expiry of the jobs still held with `token`. Returns how many there are."""
+    db = Database(db_path)
+    with db.get_cursor() as c:
+        c.execute("UPDATE notifiche_coda SET lease_scadenza = datetime('now', ?) WHERE lease_id = ?",
+                  (f"+{lease_seconds} seconds", token))
+        return c.rowcount
 
-                future_to_job = {executor.submit(_process_queue_job, job[:5]): job for job in jobs}
-                
-                for future in concurrent.futures.as_completed(future_to_job):
-                    original_job = future_to_job[future]
-                    job_id, tipo, indirizzo, oggetto, corpo, id_squadra, id_persona, tentativi = original_job
-                    
-                    _, success = future.result()
-                    
-                    if success:
-                        logging.info(f"Notification {job_id} sent successfully.")
-                        jobs_to_delete.append((job_id,))
-                        history_entries.append((tipo, indirizzo, oggetto, corpo, 'inviato', id_squadra, id_persona))
-                    else:
-                        new_attempts = tentativi + 1
-                        if new_attempts >= MAX_RETRIES:
-                            logging.error(f"Notification {job_id} failed permanently after {new_attempts} attempts.")
-                            jobs_to_delete.append((job_id,))
-                            history_entries.append((tipo, indirizzo, oggetto, corpo, 'fallito', id_squadra, id_persona))
-                        else:
-                            logging.warning(f"Notification {job_id} failed. Retry {new_attempts}/{MAX_RETRIES}.")
-                            jobs_to_update_retry.append((new_attempts, job_id))
 
-            if jobs_to_delete:
-                c.executemany("DELETE FROM notifiche_coda WHERE id_coda = ?", jobs_to_delete)
-            
-            if jobs_to_update_retry:
-                c.executemany("UPDATE notifiche_coda SET tentativi = ? WHERE id_coda = ?", jobs_to_update_retry)
-                
-            if history_entries:
-                c.executemany('''
+def retry_delay_seconds(attempts: int, base_seconds: int = NOTIFICATION_RETRY_BASE_SECONDS,
+                        max_seconds: int = NOTIFICATION_RETRY_MAX_SECONDS) -> int:
+    """Exponential backoff with jitter: between half and all of base * 2^(attempts-1), capped."""
+    delay = min(base_seconds * 2 ** (attempts - 1), max_seconds)
+    return int(delay * random.uniform(0.5, 1.0))
+
+
+@metrics.timed('db.ack_notification_jobs')
+def ack_notification_jobs(db_path: str, token: str, results: List[Tuple[Tuple, bool, int]],
+                          max_retries: Dict[str, int] = None,
+                          retry_base_seconds: int = NOTIFICATION_RETRY_BASE_SECONDS,
+                          retry_max_seconds: int = NOTIFICATION_RETRY_MAX_SECONDS) -> None:
+    """
+    Records the outcome of leased jobs in one short transaction: sent jobs
+    move to notifiche_storico, failed ones are rescheduled with an exponential
+    backoff, or move to the history as 'fallito' once the retry limit of their
+    channel is reached. Jobs whose lease was lost to another dispatcher are
+    left alone.
+    results: [(job, success, telegram parts sent so far)], a failed job keeps
+    its progress so the retry resumes from the first part not sent.
+    """
+    max_retries = max_retries or NOTIFICATION_MAX_RETRIES
+    db = Database(db_path)
+    with db.get_cursor() as c:
+        for job, success, parti_inviate in results:
+            job_id, tipo, indirizzo, oggetto, corpo, id_squadra, id_persona, tentativi, _ = job
+            new_attempts = tentativi + 1
+            channel_max_retries = max_retries.get(tipo, NOTIFICATION_MAX_RETRIES.get(tipo, NOTIFICATION_DEFAULT_MAX_RETRIES))
+
+            if success or new_attempts >= channel_max_retries:
+                c.execute("DELETE FROM notifiche_coda WHERE id_coda = ? AND lease_id = ?", (job_id, token))
+                if c.rowcount == 0:
+                    continue
+                if success:
+                    logging.info(f"Notification {job_id} sent successfully.")
+                else:
+                    logging.error(f"Notification {job_id} failed permanently after {new_attempts} attempts.")
+                c.execute('''
                     INSERT INTO notifiche_storico (tipo, indirizzo, oggetto, corpo, stato, id_squadra, id_persona)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', history_entries)
+                ''', (tipo, indirizzo, oggetto, corpo, 'inviato' if success else 'fallito', id_squadra, id_persona))
+            else:
+                delay = retry_delay_seconds(new_attempts, retry_base_seconds, retry_max_seconds)
+                logging.warning(f"Notification {job_id} failed. Retry {new_attempts}/{channel_max_retries} in {delay}s.")
+                c.execute('''
+                    UPDATE notifiche_coda
+                    SET tentativi = ?, prossimo_tentativo = datetime('now', ?), parti_inviate = ?,
+                        lease_id = NULL, lease_scadenza = NULL
+                    WHERE id_coda = ? AND lease_id = ?
+                ''', (new_attempts, f"+{delay} seconds", parti_inviate, job_id, token))
+
+
+def get_queue_depth(db_path: str) -> Dict[str, int]:
+    """Jobs waiting in notifiche_coda: all of them, the ones due now and the ones leased by a dispatcher."""
+    db = Database(db_path)
+    with db.get_cursor() as c:
+        pending, due, leased = c.execute("""
+            SELECT COUNT(*),
+                   COALESCE(SUM(prossimo_tentativo <= datetime('now')), 0),
+                   COALESCE(SUM(lease_id IS NOT NULL), 0)
+            FROM notifiche_coda
+        """).fetchone()
+    return {'pending': pending, 'due': due, 'leased': leased}
+
+
+def send_queued_notifications(db_path: str, MAX_WORKERS: Optional[int] = None, max_retries: Dict[str, int] = None,
+                              retry_base_seconds: int = NOTIFICATION_RETRY_BASE_SECONDS,
+                              retry_max_seconds: int = NOTIFICATION_RETRY_MAX_SECONDS) -> None:
+    """
+    Sends the due jobs of the queue, one message per recipient (see coalesce_jobs).
+    MAX_WORKERS defaults to the max of the 'telegram' and 'smtp' concurrency limits.
+    max_retries: dict {'email': n, 'telegram': n}
+    """
+    MAX_WORKERS = MAX_WORKERS or concurrency.max_workers('telegram', 'smtp')
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            while True:
+                token, jobs = claim_notification_jobs(db_path, CLAIM_BATCH_SIZE)
+                if not jobs:
+                    return
+                leased_at = time.monotonic()
+
+                metrics.incr('notifications.claimed', len(jobs))
+                deliveries = coalesce_jobs(jobs)
+                metrics.incr('notifications.messages', len(deliveries))
+                if len(deliveries) < len(jobs):
+                    logging.info(f"{len(jobs)} notifications coalesced into {len(deliveries)} messages")
+
+                email_deliveries = [d for d in deliveries if d[0][1] == 'email']
+                batches = ([[d] for d in deliveries if d[0][1] != 'email']
+                           + _split_email_batches(email_deliveries, EMAIL_BATCH_SIZE))
+                future_to_batch = {executor.submit(_process_queue_jobs, [message for message, _ in batch]): batch
+                                   for batch in batches}
+
+                results = []
+                running = set(future_to_batch)
+                while running:
+                    renew_in = leased_at + LEASE_RENEW_SECONDS - time.monotonic()
+                    done, running = concurrent.futures.wait(running, timeout=max(0.0, renew_in),
+                                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        batch = future_to_batch[future]
+                        try:
+                            outcomes = future.result()
+                        except Exception as e:
+                            logging.error(f"Error while sending notifications {[message[0] for message, _ in batch]}: {e}")
+                            outcomes = [(False, message[5]) for message, _ in batch]
+                        for (_, original_jobs), (success, parts_sent) in zip(batch, outcomes):
+                            results.extend((job, success, parts_sent) for job in original_jobs)
+                    if len(results) >= ACK_BATCH_SIZE or (results and not running):
+                        ack_notification_jobs(db_path, token, results, max_retries, retry_base_seconds, retry_max_seconds)
+                        results = []
+                    if running and time.monotonic() - leased_at >= LEASE_RENEW_SECONDS:
+                        extend_notification_lease(db_path, token)
+                        leased_at = time.monotonic()
 
     except Exception as e:
         logging.error(f"Error sending notification queue: {e}")
-
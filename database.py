@@ -1,16 +1,82 @@
 import sqlite3
 import logging
+import queue
+import threading
 from contextlib import contextmanager
 
+# Connections are pooled per database file for the whole process instead of
+# being opened and closed on every helper call. A connection is only ever used
+# by the thread that checked it out, so check_same_thread can be disabled.
+POOL_SIZE = 8
+BUSY_TIMEOUT_SECONDS = 30
+CACHED_STATEMENTS = 256
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",     # readers no longer wait for the writer
+    "PRAGMA synchronous = NORMAL",   # durable with WAL, no fsync on every commit
+    "PRAGMA cache_size = -16000",    # ~16 MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(db_path: str) -> queue.LifoQueue:
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = queue.LifoQueue(maxsize=POOL_SIZE)
+        return pool
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_SECONDS,
+                           cached_statements=CACHED_STATEMENTS, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def close_all_connections() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logging.error(f"Error while closing database connection: {e}")
+
+
 class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
 
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return _get_pool(self.db_path).get_nowait()
+        except queue.Empty:
+            return _open_connection(self.db_path)
+
+    def _checkin(self, conn: sqlite3.Connection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _get_pool(self.db_path).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
     @contextmanager
     def get_connection(self):
         conn = None
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._checkout()
             yield conn
         except sqlite3.Error as e:
             logging.error(f"Database error: {e}")
@@ -19,7 +85,7 @@ class Database:
             raise
         finally:
             if conn:
-                conn.close()
+                self._checkin(conn)
 
     @contextmanager
     def get_cursor(self):
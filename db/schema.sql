@@ -5,9 +5,18 @@ CREATE TABLE IF NOT EXISTS persone (
     data_di_nascita TEXT,
     data_di_morte TEXT,
     link_wikidata TEXT,
-    id_wikidata TEXT UNIQUE
+    id_wikidata TEXT UNIQUE,
+    ultima_revisione INTEGER, -- Wikidata lastrevid seen at the last update
+    ultima_modifica TEXT, -- Wikidata modification timestamp of that revision
+    prossimo_controllo TIMESTAMP -- living people are not rechecked before this time
 );
 
+CREATE TABLE IF NOT EXISTS ricerche_fallite (
+    nome_originale TEXT NOT NULL PRIMARY KEY,
+    tentativi INTEGER DEFAULT 0,
+    ultimo_tentativo TIMESTAMP,
+    prossimo_tentativo TIMESTAMP -- no new search before this time
+);
 
 
 CREATE TABLE IF NOT EXISTS squadre (
@@ -44,6 +53,10 @@ CREATE TABLE IF NOT EXISTS notifiche_coda (
     id_persona INTEGER,
     stato TEXT DEFAULT 'in_attesa', -- 'in_attesa' o 'fallito'
     tentativi INTEGER DEFAULT 0,
+    lease_id TEXT, -- dispatcher currently holding the job
+    lease_scadenza TIMESTAMP, -- the job can be claimed again after this time
+    prossimo_tentativo TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- not sent before this time (retry backoff)
+    parti_inviate INTEGER DEFAULT 0, -- telegram: parts of a long message already sent, a retry resumes after them
     FOREIGN KEY (id_squadra) REFERENCES squadre(id_squadra) ON DELETE CASCADE,
     FOREIGN KEY (id_persona) REFERENCES persone(id_persona) ON DELETE CASCADE
 );
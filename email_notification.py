@@ -2,9 +2,16 @@ import smtplib
 import configparser
 import logging
 import os
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
 from email.message import EmailMessage
 
+import concurrency
+import metrics
+
 load_dotenv()
 
 try:
@@ -14,33 +21,177 @@ try:
     SMTP_PORT = int(config['SMTP']['SMTP_PORT'])
     SMTP_USER = config['SMTP']['SMTP_USER']
     SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+    # both can be disabled to run against a local test server (e.g. aiosmtpd)
+    SMTP_STARTTLS = config.getboolean('SMTP', 'SMTP_STARTTLS', fallback=True)
+    SMTP_AUTH = config.getboolean('SMTP', 'SMTP_AUTH', fallback=True)
+    SMTP_POOL_SIZE = config.getint('SMTP', 'SMTP_POOL_SIZE', fallback=2)
     IS_EMAIL_CONFIGURED = True
 except Exception as e:
     logging.warning(f"Email configuration incomplete or not valid. Disabled.")
     IS_EMAIL_CONFIGURED = False
+    SMTP_STARTTLS = SMTP_AUTH = True
+    SMTP_POOL_SIZE = 2
 
+SMTP_TIMEOUT_SECONDS = 30
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100  # providers close sessions after a while anyway
+SMTP_IDLE_CHECK_SECONDS = 60  # sessions idle for longer are checked with NOOP before use
+SMTP_THROTTLE_CODES = {421, 450, 451, 452}  # reported to the concurrency limiter as throttling
 
-def send_email_notification(recipient_email, subject, body):
-    if not IS_EMAIL_CONFIGURED or not SMTP_USER or not SMTP_PASSWORD:
+# A few authenticated sessions shared by the dispatcher threads: a session is
+# used by one thread at a time, the semaphore bounds how many are open.
+_idle = queue.LifoQueue()
+_slots = threading.BoundedSemaphore(max(1, SMTP_POOL_SIZE))
+
+
+class _Session:
+    def __init__(self):
+        self.server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=SMTP_TIMEOUT_SECONDS)
+        try:
+            if SMTP_STARTTLS:
+                self.server.starttls()
+            if SMTP_AUTH:
+                self.server.login(SMTP_USER, SMTP_PASSWORD)
+        except BaseException:
+            # a failed handshake must not leak the socket, the pool reconnects on every failure
+            self.server.close()
+            raise
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+    def is_usable(self) -> bool:
+        if self.sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+            return False
+        if time.monotonic() - self.last_used < SMTP_IDLE_CHECK_SECONDS:
+            return True
+        try:
+            return self.server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                self.server.close()
+            except OSError:
+                pass
+
+
+def _is_configured() -> bool:
+    if not IS_EMAIL_CONFIGURED or not SMTP_USER or (SMTP_AUTH and not SMTP_PASSWORD):
         logging.error("Email configuration is missing or incomplete. Cannot send email.")
         return False
+    return True
+
+
+def _checkout() -> Optional[_Session]:
+    """Waits for a free slot and returns an idle usable session, None if a new one must be opened."""
+    _slots.acquire()
+    while True:
+        try:
+            session = _idle.get_nowait()
+        except queue.Empty:
+            return None
+        if session.is_usable():
+            return session
+        session.close()
+
+
+def _checkin(session: Optional[_Session]) -> None:
+    if session is not None:
+        session.last_used = time.monotonic()
+        _idle.put(session)
+    _slots.release()
 
+
+def close_email_connections() -> None:
+    """Logs out of the idle SMTP sessions."""
+    while True:
+        try:
+            session = _idle.get_nowait()
+        except queue.Empty:
+            return
+        session.close()
+
+
+def _deliver(session: _Session, msg: EmailMessage) -> None:
+    """Sends one message holding a slot of the 'smtp' concurrency limiter."""
+    with concurrency.get_limiter('smtp').slot() as slot, metrics.timer('smtp.send'):
+        try:
+            session.server.send_message(msg)
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code in SMTP_THROTTLE_CODES:
+                slot.throttled()
+            raise
+        except (smtplib.SMTPServerDisconnected, TimeoutError):
+            slot.throttled()
+            raise
+    session.sent += 1
+
+
+def _build_message(recipient_email: str, subject: str, body: str) -> EmailMessage:
     msg = EmailMessage()
     msg['Subject'] = subject
     msg['From'] = SMTP_USER
     msg['To'] = recipient_email
     msg.set_content(body)
+    return msg
+
+
+def send_email_batch(messages: List[Tuple[str, str, str]]) -> List[bool]:
+    """
+    Sends [(recipient, subject, body), ...] through one pooled session and
+    returns one success flag per message. A dropped session is reopened
+    once and the message retried; a refused recipient only fails its own
+    message.
+    """
+    if not messages:
+        return []
+    if not _is_configured():
+        return [False] * len(messages)
 
+    results = []
+    session = _checkout()
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.send_message(msg)
-            logging.info(f"Email sent to {recipient_email}")
-            return True
-    except smtplib.SMTPException as e:
-        logging.error(f"SMTP error while sending to {recipient_email}: {e}")
-        return False
-    except Exception as e:
-        logging.error(f"Error while sending email: {e}")
-        return False
\ No newline at end of file
+        for i, (recipient_email, subject, body) in enumerate(messages):
+            msg = _build_message(recipient_email, subject, body)
+            for attempt in range(2):
+                try:
+                    if session is None:
+                        with metrics.timer('smtp.connect'):
+                            session = _Session()
+                    _deliver(session, msg)
+                    logging.info(f"Email sent to {recipient_email}")
+                    metrics.incr('smtp.sent')
+                    results.append(True)
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                    logging.error(f"SMTP error while sending to {recipient_email}: {e}")
+                    metrics.incr('smtp.failed')
+                    results.append(False)
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    # connection dropped or server busy, start over on a new session
+                    if session is not None:
+                        session.close()
+                        session = None
+                    if attempt:
+                        logging.error(f"SMTP error while sending to {recipient_email}: {e}")
+                        metrics.incr('smtp.failed')
+                        results.append(False)
+                    else:
+                        metrics.incr('smtp.reconnects')
+                        logging.warning(f"SMTP session lost while sending to {recipient_email} ({e}), reconnecting")
+            if session is None:
+                # the server cannot be reached, the rest is retried with the queue backoff
+                results.extend([False] * (len(messages) - i - 1))
+                break
+    finally:
+        _checkin(session)
+
+    return results
+
+
+def send_email_notification(recipient_email, subject, body):
+    return send_email_batch([(recipient_email, subject, body)])[0]
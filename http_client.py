@@ -0,0 +1,149 @@
+import time
+import random
+import logging
+import threading
+from contextlib import nullcontext
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import concurrency
+import metrics
+
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) seconds
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503, 504}  # reported to the concurrency limiter as throttling
+
+_session = None
+_session_lock = threading.Lock()
+_pool_size = 10
+
+_stats = {'requests': 0, 'retries': 0, 'errors': 0, 'bytes': 0}
+_stats_lock = threading.Lock()
+
+
+def configure(pool_size: int) -> None:
+    """Sizes the connection pool, call it before the first request (e.g. with the worker count)."""
+    global _pool_size, _session
+    with _session_lock:
+        _pool_size = max(1, pool_size)
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def _count(key: str, amount: int = 1) -> None:
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def get_stats() -> Dict[str, int]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+def _is_maxlag(response: requests.Response) -> bool:
+    # the MediaWiki API answers 200 with an error body when maxlag is exceeded
+    return (response.status_code == 200
+            and 'json' in response.headers.get('Content-Type', '')
+            and b'"maxlag"' in response.content[:300])
+
+
+def _backoff(attempt: int, retry_after: Optional[float]) -> None:
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, BACKOFF_MAX_SECONDS))
+    time.sleep(delay)
+
+
+def get(url: str, params: Optional[dict] = None, headers: Optional[dict] = None,
+        timeout=DEFAULT_TIMEOUT, max_retries: int = MAX_RETRIES,
+        limiter: Optional[concurrency.AdaptiveLimiter] = None, metric: Optional[str] = None) -> requests.Response:
+    """
+    See _get. With `metric` the whole call, retries included, is timed by
+    the metrics module under that name (failures count as `metric`.errors).
+    """
+    with metrics.timer(metric) if metric else nullcontext():
+        return _get(url, params, headers, timeout, max_retries, limiter)
+
+
+def _get(url: str, params: Optional[dict], headers: Optional[dict], timeout, max_retries: int,
+         limiter: Optional[concurrency.AdaptiveLimiter]) -> requests.Response:
+    """
+    GET through the shared session. Connection errors, timeouts, 429/5xx and
+    MediaWiki maxlag answers are retried with jittered exponential backoff,
+    honoring Retry-After. Raises requests.exceptions.RequestException once the
+    retries are exhausted.
+    With a limiter every attempt holds one of its slots (the backoff does
+    not), and 429/503/504, timeouts and maxlag are reported as throttling.
+    """
+    session = get_session()
+    attempt = 0
+    while True:
+        _count('requests')
+        response, error = None, None
+        with concurrency.slot(limiter) as slot:
+            try:
+                response = session.get(url, params=params, headers=headers, timeout=timeout)
+                _count('bytes', len(response.content))
+                if response.status_code in THROTTLE_STATUSES or _is_maxlag(response):
+                    slot.throttled()
+                elif not response.ok:
+                    slot.failed()
+            except requests.exceptions.Timeout as e:
+                slot.throttled()
+                error = e
+            except requests.exceptions.ConnectionError as e:
+                slot.failed()
+                error = e
+
+        if error is not None:
+            if attempt >= max_retries:
+                _count('errors')
+                raise error
+            logging.warning(f"Request to {url} failed ({error}), retry {attempt + 1}/{max_retries}")
+            _count('retries')
+            _backoff(attempt, None)
+            attempt += 1
+            continue
+
+        if response.status_code in RETRY_STATUSES or _is_maxlag(response):
+            if attempt >= max_retries:
+                _count('errors')
+                response.raise_for_status()
+                raise requests.exceptions.RetryError(f"Server lagged, giving up on {url}", response=response)
+            logging.warning(f"Request to {url} answered {response.status_code}, retry {attempt + 1}/{max_retries}")
+            _count('retries')
+            _backoff(attempt, _retry_after_seconds(response))
+            attempt += 1
+            continue
+
+        if not response.ok:
+            _count('errors')
+        return response
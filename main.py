@@ -1,22 +1,47 @@
 import logging
 import sys
 import os
+import argparse
+import asyncio
 import configparser
+import signal
+import threading
+import time
 import concurrent.futures
-from typing import Tuple, Optional
+from typing import Any, Callable, Dict, Tuple, Optional, List, Set
 
 from data_manager import (
     create_database_and_tables,
     get_already_processed_info,
-    insert_or_update_person,
-    get_team_data_from_files,
+    bulk_upsert_persons,
     associate_teams,
+    ResolutionCache,
+    get_failed_lookups_not_due,
+    record_failed_lookups,
+    clear_failed_lookups,
+    get_stored_revisions,
+    get_names_due_for_recheck,
+    get_queue_depth,
+    schedule_rechecks,
+    save_revisions,
+    check_query_plans,
     queue_new_death_notifications,
-    send_queued_notifications
+    send_queued_notifications,
+    NOTIFICATION_MAX_RETRIES as DEFAULT_NOTIFICATION_MAX_RETRIES,
+    NOTIFICATION_RETRY_BASE_SECONDS as DEFAULT_NOTIFICATION_RETRY_BASE_SECONDS,
+    NOTIFICATION_RETRY_MAX_SECONDS as DEFAULT_NOTIFICATION_RETRY_MAX_SECONDS
 )
-from wikidata_api import find_wikidata_id, get_person_data
+from wikidata_api import find_wikidata_id, find_wikidata_ids, get_changed_people_data
 from telegram_notification import send_telegram_notification
-from teams_downloader_gsheet import teams_downloader
+from teams_downloader_gsheet import teams_downloader, set_roster_associated
+from database import close_all_connections
+from email_notification import close_email_connections
+import recentchanges_listener
+import telegram_notification
+import http_client
+import concurrency
+import metrics
+import pipeline
 
 
 config = configparser.ConfigParser()
@@ -24,11 +49,34 @@ config.read('conf/general_config.ini')
 
 DATABASE_FILE = config['GENERALI']['DATABASE_FILE']
 LOG_FILE = config['GENERALI']['LOG_FILE']
+LOG_LEVEL = config.get('GENERALI', 'LOG_LEVEL', fallback='ERROR')
 TEAMS_FOLDER = config['GENERALI']['TEAMS_FOLDER']
 GOOGLE_SHEET_ID = config['GENERALI']['GOOGLE_SHEET_ID']
+TEAMS_MIRROR = config.getboolean('GENERALI', 'TEAMS_MIRROR', fallback=False)
+NOT_FOUND_RETRY_BASE_HOURS = config.getint('GENERALI', 'NOT_FOUND_RETRY_BASE_HOURS', fallback=6)
+NOT_FOUND_RETRY_MAX_HOURS = config.getint('GENERALI', 'NOT_FOUND_RETRY_MAX_HOURS', fallback=720)
 
-MAX_WORKERS_WIKIDATA = 5
-MAX_WORKERS_NOTIFICATIONS = 10 
+# the defaults of the queue (data_manager) apply to the keys missing from [NOTIFICHE]
+NOTIFICATION_MAX_RETRIES = {
+    channel: config.getint('NOTIFICHE', f'MAX_TENTATIVI_{channel.upper()}', fallback=default)
+    for channel, default in DEFAULT_NOTIFICATION_MAX_RETRIES.items()
+}
+NOTIFICATION_RETRY_BASE_SECONDS = config.getint('NOTIFICHE', 'RETRY_BASE_SECONDS',
+                                                fallback=DEFAULT_NOTIFICATION_RETRY_BASE_SECONDS)
+NOTIFICATION_RETRY_MAX_SECONDS = config.getint('NOTIFICHE', 'RETRY_MAX_SECONDS',
+                                               fallback=DEFAULT_NOTIFICATION_RETRY_MAX_SECONDS)
+
+REPORT_FILE = config.get('METRICHE', 'REPORT_FILE',
+                         fallback=os.path.join(os.path.dirname(LOG_FILE), 'fantamorto_report.json'))
+PROMETHEUS_FILE = config.get('METRICHE', 'PROMETHEUS_FILE', fallback='')
+
+DAEMON_SHEET_SYNC_SECONDS = 60 * config.getint('DAEMON', 'SHEET_SYNC_MINUTES', fallback=15)
+DAEMON_RECHECK_SECONDS = 60 * config.getint('DAEMON', 'RECHECK_MINUTES', fallback=60)
+DAEMON_DISPATCH_SECONDS = config.getint('DAEMON', 'DISPATCH_SECONDS', fallback=60)
+
+# threads enough for the max concurrency limits, the limiters decide how many actually run
+MAX_WORKERS_WIKIDATA = concurrency.max_workers('wikidata_api')
+HTTP_POOL_SIZE = concurrency.max_workers('wikidata_api', 'sparql')
 
 
 def setup_logging() -> None:
@@ -36,7 +84,7 @@ def setup_logging() -> None:
     if log_dir and not os.path.exists(log_dir):
         os.makedirs(log_dir)
     logging.basicConfig(
-        level=logging.ERROR,
+        level=getattr(logging, LOG_LEVEL.upper(), logging.ERROR),
         format='%(asctime)s - %(levelname)s - %(message)s',
         handlers=[
             logging.FileHandler(LOG_FILE, encoding='utf-8'),
@@ -45,9 +93,23 @@ def setup_logging() -> None:
     )
 
 
-def process_name(name: str) -> Tuple[str, Optional[str]]:
+def report_query_plans() -> bool:
+    """Logs every hot query that scans a table or a whole index, see check_query_plans. True if none does."""
+    problems = check_query_plans(DATABASE_FILE)
+    for problem in problems:
+        logging.error(f"Full scan in {problem}")
+    return not problems
+
+
+@metrics.timed('stage.dispatch')
+def dispatch_notifications() -> None:
+    send_queued_notifications(DATABASE_FILE, None, NOTIFICATION_MAX_RETRIES,
+                              NOTIFICATION_RETRY_BASE_SECONDS, NOTIFICATION_RETRY_MAX_SECONDS)
+
+
+def process_name(name: str, cache: Optional[ResolutionCache] = None) -> Tuple[str, Optional[str]]:
     try:
-        q_id = find_wikidata_id(DATABASE_FILE, name)
+        q_id = find_wikidata_id(DATABASE_FILE, name, cache)
         if q_id == -1:
             return (name, "-1")
         if q_id:
@@ -59,91 +121,367 @@ def process_name(name: str) -> Tuple[str, Optional[str]]:
         return (name, "-1")
 
 
-def main() -> None:
+@metrics.timed('stage.sync_teams')
+def sync_teams() -> Tuple[bool, Set[str], Dict[str, Dict[str, Any]]]:
+    logging.info("Downloading teams")
+    return teams_downloader(GOOGLE_SHEET_ID, TEAMS_FOLDER, TEAMS_MIRROR)
+
+
+@metrics.timed('stage.resolve')
+def resolve_names(names_to_process: Set[str], resolution_cache: ResolutionCache) -> Tuple[Dict[str, str], Set[str]]:
+    """Returns: ({name: q_id} for the resolved names, names not found)"""
+    original_names_map = {}
+    not_found_names = set()
+    try:
+        # exact label matches are resolved many at a time, the rest go through the search API
+        original_names_map.update(find_wikidata_ids(DATABASE_FILE, names_to_process, resolution_cache))
+        names_to_search = names_to_process - original_names_map.keys()
+        logging.info(f"{len(original_names_map)} names resolved in batch, {len(names_to_search)} left to search.")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_WIKIDATA) as executor:
+            future_to_name = {executor.submit(process_name, name, resolution_cache): name for name in names_to_search}
+
+            for future in concurrent.futures.as_completed(future_to_name):
+                name, q_id = future.result()
+
+                if q_id == "-1" or q_id == -1:
+                    msg = f'Critical error during search for {name} (q_id = -1). Stopping.'
+                    logging.error(msg)
+                    send_telegram_notification(msg)
+                    raise Exception(msg)
+
+                elif q_id:
+                    original_names_map[name] = q_id
+
+                else:
+                    not_found_names.add(name)
+    finally:
+        # write back the new resolutions in one transaction
+        resolution_cache.flush()
+
+    return original_names_map, not_found_names
+
+
+@metrics.timed('stage.record_resolution')
+def record_resolution_outcome(original_names_map: Dict[str, str], not_found_names: Set[str]) -> None:
+    not_found_records = {
+        name: {
+            'nome': 'Not found',
+            'data_di_nascita': None,
+            'data_di_morte': None,
+            'wikidata_url': 'Not found',
+            'id_wikidata': None
+        }
+        for name in not_found_names
+    }
+    bulk_upsert_persons(DATABASE_FILE, not_found_records)
+
+    clear_failed_lookups(DATABASE_FILE, set(original_names_map.keys()))
+    attempts = record_failed_lookups(DATABASE_FILE, not_found_names,
+                                     NOT_FOUND_RETRY_BASE_HOURS, NOT_FOUND_RETRY_MAX_HOURS)
+    for name, attempt in attempts.items():
+        # alert only the first time, later failures are just rescheduled
+        if attempt == 1:
+            send_telegram_notification(f"Wikidata ID not found for: {name}")
+
+
+@metrics.timed('stage.refresh')
+def refresh_people(original_names_map: Dict[str, str], new_names: Set[str]) -> None:
+    """Downloads and stores the data of the resolved people whose Wikidata item changed."""
+    records, revisions = get_changed_people_data(original_names_map.items(), get_stored_revisions(DATABASE_FILE),
+                                                 new_names)
+    if records:
+        bulk_upsert_persons(DATABASE_FILE, records)
+        save_revisions(DATABASE_FILE, revisions)
+
+
+@metrics.timed('stage.update_people')
+def update_people(names_from_teams: Set[str], resolution_cache: ResolutionCache,
+                  recheck_living: bool = True, use_async: bool = False,
+                  team_associations: Optional[Dict[str, Dict[str, Any]]] = None) -> Tuple[Set[str], Dict[str, str]]:
+    """
+    Resolves the new names and, with recheck_living, the people still alive
+    whose next check is due (see schedule_rechecks).
+    With use_async the names go through the asyncio pipeline, which also
+    notifies the deaths it finds along the way (see pipeline.run_pipeline).
+    Returns: (new names, {name: q_id} of the resolved names)
+    """
+    processed_names, living_names = get_already_processed_info(DATABASE_FILE)
+
+    new_names = names_from_teams - processed_names
+    names_to_recheck = set()
+    if recheck_living:
+        names_to_recheck = living_names & names_from_teams & get_names_due_for_recheck(DATABASE_FILE)
+        not_due = len(living_names & names_from_teams) - len(names_to_recheck)
+        if not_due:
+            logging.info(f"{not_due} living people not due for a recheck yet.")
+    names_to_process = new_names | names_to_recheck
+
+    backing_off = get_failed_lookups_not_due(DATABASE_FILE) & names_to_process
+    if backing_off:
+        logging.info(f"Skipping {len(backing_off)} names not found on previous runs (retry not due yet).")
+        names_to_process -= backing_off
+
+    if not names_to_process:
+        logging.info("No names to process.")
+        return new_names, {}
+
+    logging.info(f"{len(names_to_process)} names to process.")
+    metrics.set_gauge('people.to_process', len(names_to_process))
+    if use_async:
+        original_names_map, not_found_names = asyncio.run(pipeline.run_pipeline(
+            DATABASE_FILE, names_to_process, new_names, team_associations or {}, resolution_cache, dispatch_notifications))
+        record_resolution_outcome(original_names_map, not_found_names)
+        return new_names, original_names_map
+
+    original_names_map, not_found_names = resolve_names(names_to_process, resolution_cache)
+    record_resolution_outcome(original_names_map, not_found_names)
+    refresh_people(original_names_map, new_names)
+    return new_names, original_names_map
+
+
+@metrics.timed('stage.update_teams')
+def update_teams(roster_changed: bool, new_names: Set[str], team_associations: Dict[str, Dict[str, Any]],
+                 original_names_map: Dict[str, str]) -> bool:
+    """
+    Syncs the team associations when the roster or the people changed. The
+    outcome is kept in the sheet state, so a failed sync is retried on the
+    next run even if the sheet does not change.
+    Returns False if the association failed.
+    """
+    if not roster_changed and not new_names:
+        logging.info("Roster unchanged and no new people, team associations are up to date")
+        return True
+    logging.info("Associating teams")
+    associated = associate_teams(DATABASE_FILE, team_associations, original_names_map)
+    set_roster_associated(TEAMS_FOLDER, associated)
+    return associated
+
+
+@metrics.timed('stage.notify')
+def notify() -> None:
+    logging.info("Queueing notifications if needed")
+    queue_new_death_notifications(DATABASE_FILE)
+
+    logging.info("Sending notifications if needed")
+    dispatch_notifications()
+
+
+def log_stats() -> None:
+    logging.info(f"HTTP stats: {http_client.get_stats()}")
+    logging.info(f"Telegram stats: {telegram_notification.get_stats()}")
+    logging.info(f"Concurrency limits: {concurrency.get_stats()}")
+
+
+def write_run_report(status: str, mode: str) -> None:
+    """Writes the JSON run report (and the Prometheus textfile if configured), never fails the run."""
+    try:
+        for name, value in get_queue_depth(DATABASE_FILE).items():
+            metrics.set_gauge(f"queue.{name}", value)
+        metrics.write_report(REPORT_FILE, {
+            'status': status,
+            'mode': mode,
+            'http': http_client.get_stats(),
+            'telegram': telegram_notification.get_stats(),
+            'concurrency': concurrency.get_stats()
+        })
+        if PROMETHEUS_FILE:
+            metrics.write_prometheus(PROMETHEUS_FILE)
+    except Exception as e:
+        logging.error(f"Error while writing the run report: {e}")
+
+
+def main(force_resolve: Optional[List[str]] = None, force_resolve_all: bool = False, use_async: bool = False) -> None:
+    started = time.monotonic()
     setup_logging()
     logging.info("Starting FantaMorto notifier")
+    leftover_dispatch = None
+    status = 'ok'
 
     try:
+        http_client.configure(HTTP_POOL_SIZE)
         create_database_and_tables(DATABASE_FILE)
+        report_query_plans()
 
-        logging.info("Downloading teams")
-        teams_downloader(GOOGLE_SHEET_ID, TEAMS_FOLDER)
-        
-        logging.info("Reading team files")
-        names_from_teams, team_associations = get_team_data_from_files(TEAMS_FOLDER)
+        # notifications left from previous runs go out while the other stages run
+        leftover_dispatch = threading.Thread(target=dispatch_notifications, daemon=True)
+        leftover_dispatch.start()
+
+        if force_resolve_all:
+            clear_failed_lookups(DATABASE_FILE)
+        elif force_resolve:
+            clear_failed_lookups(DATABASE_FILE, set(force_resolve))
+
+        roster_changed, names_from_teams, team_associations = sync_teams()
         
         if not names_from_teams:
-            logging.info("No teams or players found in the specified folder.")
+            logging.info("No teams or players found in the sheet.")
             return
 
-        processed_names, living_names = get_already_processed_info(DATABASE_FILE)
-        
-        new_names = names_from_teams - processed_names
-        names_to_recheck = living_names & names_from_teams
-        names_to_process = new_names | names_to_recheck
-        
-        if not names_to_process:
-            logging.info("No names to process.")
-        else:
-            logging.info(f"{len(names_to_process)} names to process.")
-            
-            original_names_map = {}
-                        
-            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_WIKIDATA) as executor:
-                future_to_name = {executor.submit(process_name, name): name for name in names_to_process}
-                
-                for future in concurrent.futures.as_completed(future_to_name):
-                    name, q_id = future.result()
-                    
-                    if q_id == "-1" or q_id == -1:
-                        msg = f'Critical error during search for {name} (q_id = -1). Stopping.'
-                        logging.error(msg)
-                        send_telegram_notification(msg)
-                        raise Exception(msg)
-                    
-                    elif q_id:
-                        original_names_map[name] = q_id
-                    
-                    else:
-                        data_to_save = {
-                            'nome': 'Not found',
-                            'data_di_nascita': None,
-                            'data_di_morte': None,
-                            'wikidata_url': 'Not found',
-                            'id_wikidata': None
-                        }
-                        insert_or_update_person(DATABASE_FILE, name, data_to_save)
-                        send_telegram_notification(f"Wikidata ID not found for: {name}")
-                        
-            q_ids_to_query = list(set(original_names_map.values()))
-            
-            if q_ids_to_query:
-                logging.info(f"Querying Wikidata for {len(q_ids_to_query)} IDs")
-                all_updated_data = get_person_data(q_ids_to_query) 
-
-                for name, q_id in original_names_map.items():
-                    data_to_save = {}
-                    if q_id and q_id in all_updated_data:
-                        data_to_save = all_updated_data[q_id]
-                        data_to_save['id_wikidata'] = q_id
-
-                    insert_or_update_person(DATABASE_FILE, name, data_to_save)
-        
-        logging.info("Associating teams")
-        associate_teams(DATABASE_FILE, team_associations, original_names_map)
-        
-        logging.info("Queueing notifications if needed")
-        queue_new_death_notifications(DATABASE_FILE)
-        
-        logging.info("Sending notifications if needed")
-        send_queued_notifications(DATABASE_FILE, MAX_WORKERS_NOTIFICATIONS)
-        
+        resolution_cache = ResolutionCache(DATABASE_FILE)
+        resolution_cache.load()
+
+        new_names, original_names_map = update_people(names_from_teams, resolution_cache,
+                                                      use_async=use_async, team_associations=team_associations)
+        update_teams(roster_changed, new_names, team_associations, original_names_map)
+        # after the associations, so the team count of new people is known
+        with metrics.timer('stage.schedule_rechecks'):
+            schedule_rechecks(DATABASE_FILE, set(original_names_map))
+        notify()
+
+        log_stats()
+        logging.info(f"Run completed in {time.monotonic() - started:.1f}s ({'async pipeline' if use_async else 'threaded'})")
         logging.info(f"End execution\n\n")
     
     except Exception as e:
+        status = 'error'
         logging.critical(f"Critical error {e}", exc_info=True)
         send_telegram_notification(f"Critical error: {e}")
 
+    finally:
+        if leftover_dispatch:
+            leftover_dispatch.join()
+        metrics.observe('run.total', time.monotonic() - started)
+        write_run_report(status, 'async' if use_async else 'threaded')
+        close_email_connections()
+        close_all_connections()
+
+
+def run_scheduler(tasks: List[Tuple[str, float, Callable[[], None]]], stop_event: threading.Event) -> None:
+    """
+    Runs every (name, interval seconds, function) task when due, one at a
+    time, until stop_event is set. All tasks are due at startup, in order.
+    A failing task is reported and scheduled again at its next interval.
+    """
+    next_run = {name: time.monotonic() for name, _, _ in tasks}
+    while not stop_event.is_set():
+        for name, interval, task in tasks:
+            if stop_event.is_set():
+                break
+            if next_run[name] > time.monotonic():
+                continue
+            start = time.monotonic()
+            try:
+                task()
+            except Exception as e:
+                metrics.incr(f"task.{name}.errors")
+                logging.critical(f"Critical error in {name}: {e}", exc_info=True)
+                send_telegram_notification(f"Critical error in {name}: {e}")
+            metrics.observe(f"task.{name}", time.monotonic() - start)
+            logging.info(f"{name} completed in {time.monotonic() - start:.1f}s")
+            next_run[name] = time.monotonic() + interval
+        stop_event.wait(max(0.0, min(next_run.values()) - time.monotonic()))
+
+
+def daemon() -> None:
+    """
+    Keeps running: syncs the sheet, rechecks the living people and drains the
+    notification queue on the [DAEMON] intervals. The roster, the name -> ID
+    cache and the HTTP/SMTP sessions stay warm between cycles. SIGTERM and
+    SIGINT stop it after the running task.
+    """
+    started = time.monotonic()
+    setup_logging()
+    logging.info("Starting FantaMorto notifier in daemon mode")
+
+    stop_event = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop_event.set())
+
+    try:
+        http_client.configure(HTTP_POOL_SIZE)
+        create_database_and_tables(DATABASE_FILE)
+        report_query_plans()
+
+        resolution_cache = ResolutionCache(DATABASE_FILE)
+        resolution_cache.load()
+        roster = {'names': set(), 'teams': {}, 'changed': False}
+
+        def people_cycle(recheck_living: bool) -> None:
+            if not roster['names']:
+                logging.info("No teams or players found in the sheet.")
+                return
+            new_names, original_names_map = update_people(roster['names'], resolution_cache, recheck_living)
+            if update_teams(roster['changed'], new_names, roster['teams'], original_names_map):
+                roster['changed'] = False
+            with metrics.timer('stage.schedule_rechecks'):
+                schedule_rechecks(DATABASE_FILE, set(original_names_map))
+            queue_new_death_notifications(DATABASE_FILE)
+
+        def sheet_sync() -> None:
+            changed, roster['names'], roster['teams'] = sync_teams()
+            if changed:
+                roster['changed'] = True
+                # new players are resolved right away, the living ones wait for their recheck
+                people_cycle(recheck_living=False)
+
+        def dispatch() -> None:
+            dispatch_notifications()
+            log_stats()
+            write_run_report('ok', 'daemon')
+
+        logging.info(f"Daemon ready in {time.monotonic() - started:.1f}s")
+        run_scheduler([
+            ('sheet sync', DAEMON_SHEET_SYNC_SECONDS, sheet_sync),
+            ('recheck', DAEMON_RECHECK_SECONDS, lambda: people_cycle(recheck_living=True)),
+            ('dispatch', DAEMON_DISPATCH_SECONDS, dispatch)
+        ], stop_event)
+        logging.info("Daemon stopped")
+
+    except Exception as e:
+        logging.critical(f"Critical error in daemon {e}", exc_info=True)
+        send_telegram_notification(f"Critical error in daemon: {e}")
+
+    finally:
+        close_email_connections()
+        close_all_connections()
+
+
+def listen(stream_url: str, reconnect: bool = True) -> None:
+    setup_logging()
+    logging.info("Starting FantaMorto notifier in listener mode")
+    try:
+        http_client.configure(HTTP_POOL_SIZE)
+        create_database_and_tables(DATABASE_FILE)
+        report_query_plans()
+        recentchanges_listener.listen(DATABASE_FILE, stream_url, dispatch_notifications, reconnect=reconnect)
+    except KeyboardInterrupt:
+        logging.info("Listener stopped")
+    except Exception as e:
+        logging.critical(f"Critical error in listener {e}", exc_info=True)
+        send_telegram_notification(f"Critical error in listener: {e}")
+    finally:
+        close_all_connections()
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="FantaMorto notifier")
+    parser.add_argument('--force-resolve', metavar='NAME', nargs='+',
+                        help="search these names again even if a previous search failed recently")
+    parser.add_argument('--force-resolve-all', action='store_true',
+                        help="search again every name that was not found on previous runs")
+    parser.add_argument('--check-query-plans', action='store_true',
+                        help="migrate the database, log the hot queries scanning a table or a whole index and exit (status 1 if any)")
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="stream names through the asyncio pipeline, notifying deaths as soon as they are found")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running, syncing the sheet, rechecking people and sending notifications on the [DAEMON] intervals")
+    parser.add_argument('--listen', action='store_true',
+                        help="keep running and recheck people as soon as their Wikidata item is edited")
+    parser.add_argument('--stream-url', default=recentchanges_listener.STREAM_URL,
+                        help="recent changes event stream to follow in --listen mode")
+    parser.add_argument('--no-reconnect', action='store_true',
+                        help="in --listen mode, stop when the stream ends instead of reconnecting")
+    args = parser.parse_args()
+    if args.check_query_plans:
+        setup_logging()
+        create_database_and_tables(DATABASE_FILE)
+        plans_ok = report_query_plans()
+        close_all_connections()
+        sys.exit(0 if plans_ok else 1)
+    elif args.daemon:
+        daemon()
+    elif args.listen:
+        listen(args.stream_url, reconnect=not args.no_reconnect)
+    else:
+        main(force_resolve=args.force_resolve, force_resolve_all=args.force_resolve_all, use_async=args.use_async)
@@ -0,0 +1,141 @@
+import os
+import re
+import json
+import time
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+PROMETHEUS_PREFIX = 'fantamorto_'
+MAX_SAMPLES = 10000  # per timer, the oldest samples are dropped (daemon mode)
+QUANTILES = (0.5, 0.9, 0.99)
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+_timers: Dict[str, Dict[str, Any]] = {}
+
+
+def incr(name: str, amount: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name: str, value: float) -> None:
+    with _lock:
+        _gauges[name] = value
+
+
+def max_gauge(name: str, value: float) -> None:
+    """Keeps the highest value seen, e.g. the peak depth of a queue."""
+    with _lock:
+        _gauges[name] = max(_gauges.get(name, value), value)
+
+
+def observe(name: str, seconds: float) -> None:
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            timer = _timers[name] = {'count': 0, 'sum': 0.0, 'samples': deque(maxlen=MAX_SAMPLES)}
+        timer['count'] += 1
+        timer['sum'] += seconds
+        timer['samples'].append(seconds)
+
+
+@contextmanager
+def timer(name: str):
+    """Times the block as `name`; an exception also counts `name.errors`."""
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        incr(f"{name}.errors")
+        raise
+    finally:
+        observe(name, time.monotonic() - start)
+
+
+def timed(name: str):
+    """Decorator timing every call of the function as `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _quantile(sorted_samples, q: float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+def snapshot() -> Dict[str, Any]:
+    """Counters, gauges, timers (count, sum, min, max, p50/p90/p99 in seconds) and cache hit rates."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timers = {name: (timer['count'], timer['sum'], sorted(timer['samples'])) for name, timer in _timers.items()}
+
+    timer_stats = {}
+    for name, (count, total, samples) in timers.items():
+        stats = {'count': count, 'sum': round(total, 4)}
+        if samples:
+            stats.update({'min': round(samples[0], 4), 'max': round(samples[-1], 4)})
+            stats.update({f"p{int(q * 100)}": round(_quantile(samples, q), 4) for q in QUANTILES})
+        timer_stats[name] = stats
+
+    hit_rates = {}
+    for name, hits in counters.items():
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            lookups = hits + counters.get(f"{prefix}.misses", 0)
+            hit_rates[f"{prefix}.hit_rate"] = round(hits / lookups, 4) if lookups else 0
+
+    return {'counters': counters, 'gauges': gauges, 'timers': timer_stats, 'hit_rates': hit_rates}
+
+
+def _write_atomic(path: str, content: str) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def write_report(path: str, extra: Optional[Dict[str, Any]] = None) -> None:
+    """Writes the snapshot (plus `extra`, e.g. the http/telegram stats) as a JSON run report."""
+    report = {'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+    report.update(extra or {})
+    report.update(snapshot())
+    _write_atomic(path, json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def _metric_name(name: str) -> str:
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def write_prometheus(path: str) -> None:
+    """Writes the metrics in the Prometheus text format, for the node_exporter textfile collector."""
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        metric = _metric_name(name) + '_total'
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+    for name, value in sorted({**data['gauges'], **data['hit_rates']}.items()):
+        metric = _metric_name(name)
+        lines += [f"# TYPE {metric} gauge", f"{metric} {value}"]
+    for name, stats in sorted(data['timers'].items()):
+        metric = _metric_name(name) + '_seconds'
+        lines.append(f"# TYPE {metric} summary")
+        for q in QUANTILES:
+            key = f"p{int(q * 100)}"
+            if key in stats:
+                lines.append(f'{metric}{{quantile="{q}"}} {stats[key]}')
+        lines += [f"{metric}_sum {stats['sum']}", f"{metric}_count {stats['count']}"]
+    _write_atomic(path, '\n'.join(lines) + '\n')
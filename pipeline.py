@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import time
+import concurrent.futures
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import concurrency
+import metrics
+from data_manager import (
+    ResolutionCache,
+    bulk_upsert_persons,
+    save_revisions,
+    get_stored_revisions,
+    associate_teams,
+    queue_new_death_notifications
+)
+from wikidata_api import (
+    find_wikidata_id,
+    find_wikidata_ids,
+    get_changed_people_data,
+    BATCH_RESOLVE_SIZE
+)
+
+# Names flow through resolve -> enrich -> persist -> queue -> send as bounded
+# asyncio queues. The blocking functions of the threaded path run through
+# asyncio.to_thread, the database is only written by the persist stage, one
+# batch at a time, so the SQLite semantics are the same.
+QUEUE_SIZE = 200
+ENRICH_WORKERS = 2
+ENRICH_BATCH_SIZE = 50
+ENRICH_BATCH_WAIT_SECONDS = 1.0  # a partial batch is enriched after this wait
+_DONE = object()
+
+
+class PipelineError(Exception):
+    pass
+
+
+async def _collect(queue: asyncio.Queue, size: int, wait: float) -> Tuple[List[Any], bool]:
+    """Takes up to `size` items, waiting at most `wait` after the first. Returns (items, input finished)."""
+    first = await queue.get()
+    if first is _DONE:
+        return [], True
+    items = [first]
+    deadline = time.monotonic() + wait
+    while len(items) < size:
+        try:
+            item = await asyncio.wait_for(queue.get(), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            break
+        if item is _DONE:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+async def run_pipeline(db_path: str, names_to_process: Set[str], new_names: Set[str],
+                       team_associations: Dict[str, Dict[str, Any]], resolution_cache: ResolutionCache,
+                       dispatch: Callable[[], None]) -> Tuple[Dict[str, str], Set[str]]:
+    """
+    Resolves, enriches and stores the given names like main.update_people
+    does, but as a stream: a person is stored as soon as its micro-batch is
+    enriched, and a death is queued and sent right away instead of after the
+    last search. The run still ends with the usual team association and
+    notify stages.
+    Returns: ({name: q_id} for the resolved names, names not found)
+    """
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(
+        max_workers=concurrency.max_workers('wikidata_api', 'sparql', 'telegram', 'smtp') + ENRICH_WORKERS + 2))
+
+    resolved_queue = asyncio.Queue(QUEUE_SIZE)
+    persist_queue = asyncio.Queue(QUEUE_SIZE)
+    send_queue = asyncio.Queue()
+    original_names_map = {}
+    not_found_names = set()
+    stored_revisions = await asyncio.to_thread(get_stored_revisions, db_path)
+
+    async def resolve() -> None:
+        batch_slots = asyncio.Semaphore(concurrency.get_limiter('sparql').max_limit)
+        search_slots = asyncio.Semaphore(concurrency.get_limiter('wikidata_api').max_limit)
+
+        async def search(name: str) -> None:
+            async with search_slots:
+                q_id = await asyncio.to_thread(find_wikidata_id, db_path, name, resolution_cache)
+            if q_id == -1:
+                raise PipelineError(f'Critical error during search for {name} (q_id = -1). Stopping.')
+            if q_id:
+                original_names_map[name] = q_id
+                await resolved_queue.put((name, q_id))
+                metrics.max_gauge('pipeline.resolved_queue_peak', resolved_queue.qsize())
+            else:
+                not_found_names.add(name)
+
+        async def resolve_chunk(chunk: List[str]) -> None:
+            # the batch matches of a chunk go downstream before its misses are searched one by one
+            async with batch_slots:
+                found = await asyncio.to_thread(find_wikidata_ids, db_path, set(chunk), resolution_cache)
+            for name, q_id in found.items():
+                original_names_map[name] = q_id
+                await resolved_queue.put((name, q_id))
+            metrics.max_gauge('pipeline.resolved_queue_peak', resolved_queue.qsize())
+            await asyncio.gather(*(search(name) for name in chunk if name not in found))
+
+        names = sorted(names_to_process)
+        try:
+            await asyncio.gather(*(resolve_chunk(names[i:i + BATCH_RESOLVE_SIZE])
+                                   for i in range(0, len(names), BATCH_RESOLVE_SIZE)))
+        finally:
+            await asyncio.to_thread(resolution_cache.flush)
+        for _ in range(ENRICH_WORKERS):
+            await resolved_queue.put(_DONE)
+
+    async def enrich() -> None:
+        finished = False
+        while not finished:
+            items, finished = await _collect(resolved_queue, ENRICH_BATCH_SIZE, ENRICH_BATCH_WAIT_SECONDS)
+            if not items:
+                continue
+            records, revisions = await asyncio.to_thread(get_changed_people_data, items, stored_revisions, new_names)
+            if not records:
+                continue
+            await persist_queue.put((records, revisions))
+            metrics.max_gauge('pipeline.persist_queue_peak', persist_queue.qsize())
+
+    async def enrich_all() -> None:
+        await asyncio.gather(*(enrich() for _ in range(ENRICH_WORKERS)))
+        await persist_queue.put(_DONE)
+
+    async def persist() -> None:
+        while True:
+            item = await persist_queue.get()
+            if item is _DONE:
+                break
+            records, revisions = item
+            await asyncio.to_thread(bulk_upsert_persons, db_path, records)
+            await asyncio.to_thread(save_revisions, db_path, revisions)
+
+            dead = [name for name, data in records.items() if data.get('data_di_morte')]
+            if not dead:
+                continue
+            if new_names.intersection(dead):
+                # new people need their team links before they can be notified
+                await asyncio.to_thread(associate_teams, db_path, team_associations, dict(original_names_map))
+            await asyncio.to_thread(queue_new_death_notifications, db_path)
+            logging.info(f"{len(dead)} deaths queued {time.monotonic() - started:.1f}s after the pipeline start")
+            metrics.observe('pipeline.death_to_queue', time.monotonic() - started)
+            send_queue.put_nowait(True)
+        send_queue.put_nowait(_DONE)
+
+    async def send() -> None:
+        while True:
+            item = await send_queue.get()
+            # several batches queued while the previous send was running go out together
+            while item is not _DONE and not send_queue.empty():
+                item = send_queue.get_nowait()
+            if item is _DONE:
+                break
+            await asyncio.to_thread(dispatch)
+
+    tasks = [asyncio.ensure_future(stage()) for stage in (resolve, enrich_all, persist, send)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    metrics.observe('stage.pipeline', time.monotonic() - started)
+    logging.info(f"Pipeline completed in {time.monotonic() - started:.1f}s for {len(names_to_process)} names")
+    return original_names_map, not_found_names
@@ -0,0 +1,155 @@
+import json
+import time
+import logging
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import requests
+
+import http_client
+from data_manager import (
+    get_watched_qids,
+    bulk_upsert_persons,
+    save_revisions,
+    queue_new_death_notifications,
+    send_queued_notifications
+)
+from wikidata_api import get_entities_data, HEADERS
+
+STREAM_URL = 'https://stream.wikimedia.org/v2/stream/recentchange'
+WIKI = 'wikidatawiki'
+BATCH_SECONDS = 5  # matches arriving within this window are refreshed together
+WATCHLIST_REFRESH_SECONDS = 600
+RECONNECT_DELAY_SECONDS = 5
+
+
+def iter_sse_events(lines: Iterable) -> Iterator[Tuple[Optional[str], str]]:
+    """Parses server-sent-events lines into (event id, data) pairs."""
+    event_id = None
+    data = []
+    for raw in lines:
+        line = raw.decode('utf-8') if isinstance(raw, bytes) else raw
+        line = line.rstrip('\r\n')
+        if line == '':
+            if data:
+                yield event_id, '\n'.join(data)
+            data = []
+            continue
+        if line.startswith(':'):
+            continue
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            data.append(value)
+        elif field == 'id':
+            event_id = value
+    if data:
+        yield event_id, '\n'.join(data)
+
+
+def match_change(change: dict, watched: Dict[str, List[str]]) -> Optional[str]:
+    """Returns the QID of a watched item edited by the change, None otherwise."""
+    if change.get('wiki') != WIKI or change.get('namespace') != 0:
+        return None
+    title = change.get('title')
+    return title if title in watched else None
+
+
+def refresh_people(db_path: str, changed: Dict[str, Tuple[int, str]], watched: Dict[str, List[str]],
+                   dispatch: Optional[Callable[[], None]] = None) -> None:
+    """
+    Runs the usual update and notification path for the changed QIDs only,
+    sending the queue with dispatch (the queue defaults if not given).
+    The items are read live (wbgetentities): seconds after an edit the query
+    service has almost never caught up with it.
+    """
+    logging.info(f"Rechecking {len(changed)} changed people: {', '.join(changed)}")
+    all_updated_data, revisions = get_entities_data(list(changed))
+
+    records = {}
+    for q_id, data in all_updated_data.items():
+        for name in watched.get(q_id, []):
+            data_to_save = dict(data)
+            data_to_save['id_wikidata'] = q_id
+            records[name] = data_to_save
+    bulk_upsert_persons(db_path, records)
+
+    # an API replica still behind the edit of the event returns an older
+    # revision: it is not stored, so the next run reads the item again
+    behind = {q_id for q_id, (revision, _) in revisions.items() if revision < (changed.get(q_id, (None, None))[0] or 0)}
+    if behind:
+        logging.warning(f"{len(behind)} items read before their last edit was visible: {', '.join(behind)}")
+    save_revisions(db_path, {q_id: revision for q_id, revision in revisions.items() if q_id not in behind})
+    queue_new_death_notifications(db_path)
+    if dispatch:
+        dispatch()
+    else:
+        send_queued_notifications(db_path)
+
+
+def listen(db_path: str, stream_url: str = STREAM_URL, dispatch: Optional[Callable[[], None]] = None,
+           stop_event: Optional[threading.Event] = None, reconnect: bool = True) -> None:
+    """
+    Follows the recentchange stream and rechecks watched people as soon as
+    their Wikidata item is edited. Reconnects with Last-Event-ID so no event
+    is lost across disconnections. Returns when stop_event is set or, with
+    reconnect=False (e.g. against a local replay), when the stream ends.
+    """
+    stop_event = stop_event or threading.Event()
+    last_event_id = None
+    watched = get_watched_qids(db_path)
+    watched_at = time.monotonic()
+    pending = {}
+    pending_since = None
+    logging.info(f"Listening for changes on {len(watched)} people")
+
+    while not stop_event.is_set():
+        headers = dict(HEADERS)
+        headers['Accept'] = 'text/event-stream'
+        if last_event_id:
+            headers['Last-Event-ID'] = last_event_id
+
+        try:
+            with http_client.get_session().get(stream_url, headers=headers, stream=True,
+                                               timeout=(5, 60)) as response:
+                response.raise_for_status()
+                for event_id, data in iter_sse_events(response.iter_lines()):
+                    if stop_event.is_set():
+                        break
+                    if event_id:
+                        last_event_id = event_id
+                    try:
+                        change = json.loads(data)
+                    except ValueError:
+                        continue
+
+                    q_id = match_change(change, watched)
+                    if q_id:
+                        pending[q_id] = (change.get('revision', {}).get('new'),
+                                         change.get('meta', {}).get('dt'))
+                        pending_since = pending_since or time.monotonic()
+
+                    if pending and time.monotonic() - pending_since >= BATCH_SECONDS:
+                        refresh_people(db_path, pending, watched, dispatch)
+                        pending, pending_since = {}, None
+
+                    if time.monotonic() - watched_at >= WATCHLIST_REFRESH_SECONDS:
+                        watched = get_watched_qids(db_path)
+                        watched_at = time.monotonic()
+                else:
+                    # the server closed the stream
+                    if pending:
+                        refresh_people(db_path, pending, watched, dispatch)
+                        pending, pending_since = {}, None
+                    if not reconnect:
+                        return
+
+        except requests.exceptions.RequestException as e:
+            if not reconnect:
+                raise
+            logging.warning(f"Recent changes stream interrupted ({e}), reconnecting in {RECONNECT_DELAY_SECONDS}s")
+            stop_event.wait(RECONNECT_DELAY_SECONDS)
+
+    if pending:
+        refresh_people(db_path, pending, watched, dispatch)
@@ -0,0 +1,105 @@
+import sys
+import json
+import time
+import logging
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+import requests
+
+from recentchanges_listener import STREAM_URL, iter_sse_events
+from wikidata_api import HEADERS
+
+# Local stand-in for the recentchange stream, to try --listen without
+# waiting for real edits:
+#   python recentchanges_replay.py record fixtures/recentchange_sample.jsonl --count 500
+#   python recentchanges_replay.py serve fixtures/recentchange_sample.jsonl --port 8765
+#   python main.py --listen --stream-url http://localhost:8765 --no-reconnect
+# Events are served in file order, the id of an event is its line number so
+# a client reconnecting with Last-Event-ID resumes after it.
+
+
+def load_events(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def record(path: str, count: int, stream_url: str = STREAM_URL, wiki: Optional[str] = None) -> None:
+    """Appends `count` events of the live stream (only those of `wiki` if given) to a JSONL file."""
+    headers = dict(HEADERS)
+    headers['Accept'] = 'text/event-stream'
+    recorded = 0
+    with requests.get(stream_url, headers=headers, stream=True, timeout=(5, 60)) as response, \
+            open(path, 'a', encoding='utf-8') as f:
+        response.raise_for_status()
+        for _, data in iter_sse_events(response.iter_lines()):
+            try:
+                change = json.loads(data)
+            except ValueError:
+                continue
+            if wiki and change.get('wiki') != wiki:
+                continue
+            f.write(json.dumps(change, ensure_ascii=False) + '\n')
+            recorded += 1
+            if recorded >= count:
+                break
+    logging.info(f"{recorded} events recorded to {path}")
+
+
+def make_handler(events: List[str], delay: float):
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                start = int(self.headers.get('Last-Event-ID', -1)) + 1
+            except ValueError:
+                start = 0
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                for event_id in range(start, len(events)):
+                    self.wfile.write(f"event: message\nid: {event_id}\ndata: {events[event_id]}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                    time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            # closing the connection ends the stream, like a server restart does
+
+        def log_message(self, format, *args):
+            logging.info(format % args)
+
+    return ReplayHandler
+
+
+def serve(path: str, port: int, delay: float) -> None:
+    events = load_events(path)
+    server = ThreadingHTTPServer(('localhost', port), make_handler(events, delay))
+    logging.info(f"Replaying {len(events)} events from {path} on http://localhost:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stdout)
+    parser = argparse.ArgumentParser(description="Record or replay the Wikimedia recentchange stream")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help="append live events to a JSONL file")
+    record_parser.add_argument('file')
+    record_parser.add_argument('--count', type=int, default=500)
+    record_parser.add_argument('--wiki', default='wikidatawiki', help="only keep the events of this wiki ('' for all)")
+    record_parser.add_argument('--stream-url', default=STREAM_URL)
+    serve_parser = commands.add_parser('serve', help="serve a JSONL file as a server-sent events stream")
+    serve_parser.add_argument('file')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--delay', type=float, default=0.05, help="seconds between two events")
+    args = parser.parse_args()
+    if args.command == 'record':
+        record(args.file, args.count, args.stream_url, args.wiki or None)
+    else:
+        serve(args.file, args.port, args.delay)
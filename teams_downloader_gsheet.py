@@ -1,11 +1,140 @@
 import os
 import re
 import csv
+import json
+import hashlib
 import requests
 import io
 import logging
+from itertools import zip_longest
+from typing import Any, Dict, List, Set, Tuple
 
-def teams_downloader(sheet_id: str, output_dir: str = "teams"):
+from data_manager import get_team_data_from_files
+
+ALL_VALUES = {"all", "1", "si", "sì", "yes", "true", "x"}
+STATE_FILENAME = ".sheet_state.json"
+
+
+def _sanitize_filename(name):
+    return re.sub(r'[\\/*?:"<>|]', "", str(name)).strip()
+
+
+def _clean_key(val):
+    return str(val).strip().lower() if val else ""
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_bytes(path: str) -> bytes:
+    if not os.path.exists(path):
+        return b""
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _load_state(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path: str, state: dict) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _roster_to_state(team_associations: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return {name: dict(data, people=sorted(data["people"])) for name, data in team_associations.items()}
+
+
+def _roster_from_state(saved: Dict[str, Dict[str, Any]]) -> Tuple[Set[str], Dict[str, Dict[str, Any]]]:
+    team_associations = {name: dict(data, people=set(data["people"])) for name, data in saved.items()}
+    all_people_names = set().union(*(data["people"] for data in team_associations.values()))
+    return all_people_names, team_associations
+
+
+def set_roster_associated(output_dir: str, associated: bool) -> None:
+    """Records in the sheet state whether the last roster returned reached the database."""
+    path = os.path.join(output_dir, STATE_FILENAME)
+    state = _load_state(path)
+    if 'roster' in state and state.get('associated') != associated:
+        state['associated'] = associated
+        _save_state(path, state)
+
+
+def parse_sheet(content: str, corrections_map: Dict[str, str],
+                contacts: Dict[Tuple[str, str], Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Parses the sheet export in a single pass: the rows are transposed once
+    into columns, every "Giocatore" column is one team, the two cells above
+    the header are team and owner. Contacts are looked up by
+    (owner, team) and corrections by normalized name, both in O(1).
+    Returns: [{"team", "owner", "email", "chat_id", "notifica_tutti", "players": [...]}]
+    """
+    rows = list(csv.reader(io.StringIO(content)))
+    if not rows:
+        raise ValueError("sheet is empty")
+
+    # find header row with "Giocatore"
+    header_row_idx = next((i for i, row in enumerate(rows)
+                           if any("Giocatore" == str(cell).strip() for cell in row)), -1)
+    if header_row_idx == -1:
+        raise ValueError("Header 'Giocatore' not found.")
+
+    num_cols = len(rows[header_row_idx])
+    columns = list(zip_longest(*rows, fillvalue=""))[:num_cols]
+    no_contacts = {'email': '', 'telegram_chat_id': '', 'notifica_tutti': 0}
+    correct = corrections_map.get
+
+    teams = []
+    for column in columns:
+        if str(column[header_row_idx]).strip() != "Giocatore":
+            continue
+
+        # metadata are in rows before header_row_idx
+        metadata = [cell for cell in column[:header_row_idx] if cell]
+        if not metadata:
+            continue
+        raw_team = metadata[0]
+        raw_person = metadata[1] if len(metadata) > 1 else "Unknown"
+
+        # estrazione, pulizia e correzione giocatori
+        players = []
+        for val in column[header_row_idx + 1:]:
+            val = str(val).strip() if val else ""
+            if val and not val.isdigit():
+                players.append(correct(_clean_key(val), val))
+        if not players:
+            continue
+
+        contact = contacts.get((_clean_key(raw_person), _clean_key(raw_team)), no_contacts)
+        teams.append({
+            "team": raw_team,
+            "owner": raw_person,
+            "email": contact['email'],
+            "chat_id": contact['telegram_chat_id'],
+            "notifica_tutti": contact['notifica_tutti'],
+            "players": players
+        })
+    return teams
+
+
+def teams_downloader(sheet_id: str, output_dir: str = "teams",
+                     write_files: bool = False) -> Tuple[bool, Set[str], Dict[str, Dict[str, Any]]]:
+    """
+    Downloads the sheet and returns the roster, in the same shape as
+    data_manager.get_team_data_from_files:
+    (changed, all people names, {"Nome Squadra": {"owner": "...", "people": {...}, "email": "...", "chat_id": "...", "notifica_tutti": 0/1}})
+    changed is False when the sheet, notifiche.csv and correzioni.csv are unchanged (state in
+    output_dir/.sheet_state.json) and the roster already reached the database (set_roster_associated).
+    With write_files the roster is also mirrored to one csv per team in output_dir.
+    """
     # --- CONFIGURAZIONE ---
     SHEET_ID = sheet_id
     GID = "0"
@@ -13,15 +142,17 @@ def teams_downloader(sheet_id: str, output_dir: str = "teams"):
     NOTIFICHE_FILE = "notifiche.csv"
     CORREZIONI_FILE = "correzioni.csv"
     OUTPUT_DIR = output_dir
+    STATE_FILE = os.path.join(OUTPUT_DIR, STATE_FILENAME)
 
     os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-    def sanitize_filename(name):
-        return re.sub(r'[\\/*?:"<>|]', "", str(name)).strip()
+    state = _load_state(STATE_FILE)
+    # an unchanged roster that never reached the database still counts as changed
+    not_associated = not state.get('associated', False)
+    local_hash = _sha256(_read_bytes(NOTIFICHE_FILE) + b"\0" + _read_bytes(CORREZIONI_FILE))
+    local_unchanged = (state.get('local_hash') == local_hash and 'roster' in state
+                       and state.get('mirror', False) == write_files)
 
-    def clean_key(val):
-        return str(val).strip().lower() if val else ""
-    
     # caricamento correzioni
     corrections_map = {}
     try:
@@ -30,123 +161,123 @@ def teams_downloader(sheet_id: str, output_dir: str = "teams"):
                 reader = csv.DictReader(f)
                 for row in reader:
                     if row.get('Nome scaricato') and row.get('Nome corretto'):
-                        corrections_map[clean_key(row['Nome scaricato'])] = row['Nome corretto'].strip()
+                        corrections_map[_clean_key(row['Nome scaricato'])] = row['Nome corretto'].strip()
         else:
             logging.info(f"Info: '{CORREZIONI_FILE}' not found. No name corrections will be applied.")
     except Exception as e:
         logging.error(f"Error loading corrections: {e}")
 
-    # caricamento notifiche
-    notifiche_data = []
+    # caricamento notifiche: (persona, squadra) -> contatti, the first matching row wins
+    contacts = {}
     try:
         if os.path.exists(NOTIFICHE_FILE):
             with open(NOTIFICHE_FILE, 'r', encoding='utf-8') as f:
                 reader = csv.DictReader(f)
                 for row in reader:
-                    notifiche_data.append({
-                        'join_persona': clean_key(row.get('Persona')),
-                        'join_squadra': clean_key(row.get('squadra')),
-                        'email': row.get('email'),
-                        'telegram_chat_id': row.get('telegram_chat_id')
+                    key = (_clean_key(row.get('Persona')), _clean_key(row.get('squadra')))
+                    contacts.setdefault(key, {
+                        'email': (row.get('email') or '').strip(),
+                        'telegram_chat_id': (row.get('telegram_chat_id') or '').strip(),
+                        'notifica_tutti': 1 if _clean_key(row.get('notifica_tutti')) in ALL_VALUES else 0
                     })
         else:
-            logging.warning(f"File '{NOTIFICHE_FILE}' not found. Files will be generated without contact data.")
+            logging.warning(f"File '{NOTIFICHE_FILE}' not found. Teams will have no contact data.")
     except Exception as e:
         logging.error(f"Error loading notifications: {e}")
 
     # caricamento sheet teams
     try:
-        response = requests.get(GOOGLE_CSV_URL)
+        headers = {}
+        if local_unchanged:
+            # the sheet content is only needed again if it changed
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+
+        response = requests.get(GOOGLE_CSV_URL, headers=headers, timeout=60)
+        if response.status_code == 304:
+            logging.info("Sheet not modified since last download.")
+            return (not_associated, *_roster_from_state(state['roster']))
         response.raise_for_status()
-        
-        # parse csv from string
-        f = io.StringIO(response.content.decode('utf-8'))
-        reader = csv.reader(f)
-        rows = list(reader)
-        
-        if not rows:
-            raise ValueError("sheet is empty")
-
-        # find header row with "Giocatore"
-        header_row_idx = -1
-        for i, row in enumerate(rows):
-            if any("Giocatore" == str(cell).strip() for cell in row):
-                header_row_idx = i
-                break
-        
-        if header_row_idx == -1:
-            raise ValueError("Header 'Giocatore' not found.")
-        
+
+        sheet_hash = _sha256(response.content)
+        if local_unchanged and state.get('sheet_hash') == sheet_hash:
+            logging.info("Sheet and local csv files unchanged since last download.")
+            # keep the new validators, a stale ETag would never get a 304 again
+            state['etag'] = response.headers.get('ETag')
+            state['last_modified'] = response.headers.get('Last-Modified')
+            _save_state(STATE_FILE, state)
+            return (not_associated, *_roster_from_state(state['roster']))
+
+        all_people_names = set()
+        team_associations = {}
         count_files = 0
-        
-        num_cols = len(rows[header_row_idx])
-        
-        for col_idx in range(num_cols):
-            # check bounds for current row
-            if col_idx >= len(rows[header_row_idx]):
+        written_files = {}
+
+        for team in parse_sheet(response.content.decode('utf-8'), corrections_map, contacts):
+            # team and owner keep the sanitized form the team files used to
+            # carry, so existing squadre rows keep matching
+            team_associations[_sanitize_filename(team['team'])] = {
+                "owner": _sanitize_filename(team['owner']),
+                "people": set(team['players']),
+                "email": team['email'] or None,
+                "chat_id": team['chat_id'] or None,
+                "notifica_tutti": team['notifica_tutti']
+            }
+            all_people_names.update(team['players'])
+
+            if not write_files:
+                continue
+
+            # costruzione filename
+            parts = [team['team'], team['owner']]
+            if team['email']: parts.append(team['email'])
+            if team['chat_id']: parts.append(team['chat_id'])
+            if team['notifica_tutti']: parts.append("ALL")
+
+            full_name = " - ".join(parts)
+            filename = f"{_sanitize_filename(full_name)}.csv"
+            file_path = os.path.join(OUTPUT_DIR, filename)
+
+            content = '\n'.join(team['players'])
+            content_hash = _sha256(content.encode('utf-8'))
+            written_files[filename] = content_hash
+            if state.get('files', {}).get(filename) == content_hash and os.path.exists(file_path):
                 continue
-                
-            cell_value = rows[header_row_idx][col_idx]
-
-            if str(cell_value).strip() == "Giocatore":
-                # metadata are in rows before header_row_idx
-                metadata = []
-                for r in range(header_row_idx):
-                    if col_idx < len(rows[r]) and rows[r][col_idx]:
-                        metadata.append(rows[r][col_idx])
-                
-                if len(metadata) >= 1:
-                    raw_team = metadata[0]
-                    raw_person = metadata[1] if len(metadata) > 1 else "Unknown"
-                else:
-                    continue
-
-                email_suffix = ""
-                telegram_suffix = ""
-
-                if notifiche_data:
-                    current_team_key = clean_key(raw_team)
-                    current_person_key = clean_key(raw_person)
-
-                    for item in notifiche_data:
-                        if item['join_persona'] == current_person_key and item['join_squadra'] == current_team_key:
-                            if item['email'] and item['email'].strip():
-                                email_suffix = item['email'].strip()
-                            if item['telegram_chat_id'] and item['telegram_chat_id'].strip():
-                                telegram_suffix = item['telegram_chat_id'].strip()
-                            break
-
-                # costruzione filename
-                parts = [raw_team, raw_person]
-                if email_suffix: parts.append(email_suffix)
-                if telegram_suffix: parts.append(telegram_suffix)
-
-                full_name = " - ".join(parts)
-                filename = f"{sanitize_filename(full_name)}.csv"
-                file_path = os.path.join(OUTPUT_DIR, filename)
-
-                # estrazione e pulizia giocatori
-                valid_players = []
-                for r in range(header_row_idx + 1, len(rows)):
-                    if col_idx < len(rows[r]):
-                        val = rows[r][col_idx]
-                        if val and str(val).strip() and not str(val).isdigit():
-                            valid_players.append(str(val).strip())
-
-                if valid_players:
-                    # applicazione correzioni
-                    final_players = [
-                        corrections_map.get(clean_key(p), p) 
-                        for p in valid_players
-                    ]
-
-                    with open(file_path, 'w', encoding='utf-8') as f_out:
-                        f_out.write('\n'.join(final_players))
-                    count_files += 1
+
+            with open(file_path, 'w', encoding='utf-8') as f_out:
+                f_out.write(content)
+            count_files += 1
+
+        if write_files:
+            # team files written by a previous download that no longer exist in the sheet
+            for old_filename in set(state.get('files', {})) - set(written_files):
+                old_path = os.path.join(OUTPUT_DIR, old_filename)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+            logging.info(f"{count_files} team files rewritten.")
+
+        _save_state(STATE_FILE, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'sheet_hash': sheet_hash,
+            'local_hash': local_hash,
+            'files': written_files,
+            'mirror': write_files,
+            'roster': _roster_to_state(team_associations),
+            'associated': False
+        })
+        return True, all_people_names, team_associations
 
     except Exception as e:
         logging.error(f"Errore: {e}")
 
+    if 'roster' in state:
+        logging.warning("Using the roster from the last successful download.")
+        return (True, *_roster_from_state(state['roster']))
+    return (True, *get_team_data_from_files(OUTPUT_DIR))
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     teams_downloader()
@@ -1,6 +1,14 @@
 import requests
 import configparser
 import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+
+import concurrency
+import metrics
 
 config = configparser.ConfigParser()
 
@@ -13,8 +21,161 @@ except Exception as e:
     GLOBAL_TG_BOT_TOKEN = None
     GLOBAL_TG_CHAT_ID = None
 
+# Bot API limits: ~30 messages/s overall, 1/s to the same private chat and
+# 20/min to the same group (group chat ids are negative)
+GLOBAL_RATE_PER_SECOND = config.getfloat('TELEGRAM', 'global_rate_per_second', fallback=30)
+CHAT_RATE_PER_SECOND = config.getfloat('TELEGRAM', 'chat_rate_per_second', fallback=1)
+GROUP_RATE_PER_MINUTE = config.getfloat('TELEGRAM', 'group_rate_per_minute', fallback=20)
+TIMEOUT = (5, 10)  # (connect, read) seconds
+POOL_SIZE = 10
+MAX_RETRIES = 3  # on 429 only, other failures go back to the queue backoff
+MAX_RETRY_AFTER_SECONDS = 60  # longer waits are left to the queue backoff
+MAX_MESSAGE_LENGTH = 4096
+
+
+class TokenBucket:
+    """Thread safe token bucket: acquire() blocks until a token is available."""
+
+    def __init__(self, rate_per_second: float, capacity: float):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        # the token is reserved under the lock, the wait happens outside it
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """No token is handed out for the next `seconds` (e.g. after a 429)."""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+_session = None
+_session_lock = threading.Lock()
+_global_bucket = TokenBucket(GLOBAL_RATE_PER_SECOND, 1)  # no burst, a 1s window never exceeds the limit
+_chat_buckets = {}
+_chat_buckets_lock = threading.Lock()
+
+_stats = {'sent': 0, 'failed': 0, 'throttled': 0, 'first_sent': None, 'last_sent': None}
+_latencies = deque(maxlen=1000)
+_stats_lock = threading.Lock()
+
+
+def _get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+        return _session
+
+
+def _chat_bucket(chat_id) -> TokenBucket:
+    with _chat_buckets_lock:
+        bucket = _chat_buckets.get(chat_id)
+        if bucket is None:
+            if str(chat_id).startswith('-'):
+                bucket = TokenBucket(GROUP_RATE_PER_MINUTE / 60, 1)
+            else:
+                bucket = TokenBucket(CHAT_RATE_PER_SECOND, 1)
+            _chat_buckets[chat_id] = bucket
+        return bucket
+
+
+def _record(success: bool, latency: Optional[float] = None) -> None:
+    metrics.incr('telegram.sent' if success else 'telegram.failed')
+    if latency is not None:
+        metrics.observe('telegram.request', latency)
+    with _stats_lock:
+        if success:
+            now = time.monotonic()
+            _stats['sent'] += 1
+            _stats['first_sent'] = _stats['first_sent'] or now
+            _stats['last_sent'] = now
+        else:
+            _stats['failed'] += 1
+        if latency is not None:
+            _latencies.append(latency)
+
+
+def get_stats() -> Dict[str, float]:
+    """Messages sent/failed/throttled (429), throughput and request latency (last 1000 requests)."""
+    with _stats_lock:
+        latencies = sorted(_latencies)
+        elapsed = (_stats['last_sent'] - _stats['first_sent']) if _stats['sent'] > 1 else 0
+        return {
+            'sent': _stats['sent'],
+            'failed': _stats['failed'],
+            'throttled': _stats['throttled'],
+            'messages_per_second': round(_stats['sent'] / elapsed, 2) if elapsed else 0,
+            'avg_latency_ms': round(1000 * sum(latencies) / len(latencies)) if latencies else 0,
+            'p95_latency_ms': round(1000 * latencies[int(len(latencies) * 0.95) - 1]) if latencies else 0
+        }
+
+
+def _retry_after(response: requests.Response) -> float:
+    try:
+        return float(response.json().get('parameters', {}).get('retry_after', 1))
+    except (ValueError, AttributeError):
+        return 1
+
+
+def split_message(message: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """Splits a text longer than the Telegram limit on line boundaries (long lines are cut)."""
+    if len(message) <= limit:
+        return [message]
+    parts, current = [], ''
+    for line in message.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ''
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _send_parts(chat_id, message, parts_sent: int = 0) -> Tuple[int, int]:
+    """
+    Sends the parts of the message (see split_message) in order, skipping the
+    first parts_sent ones (delivered by an earlier attempt) and stopping at
+    the first failure, so a retry can resume from there.
+    Returns: (parts sent so far, parts of the message)
+    """
+    parts = split_message(message)
+    for part in parts[parts_sent:]:
+        if not _send_part(chat_id, part):
+            break
+        parts_sent += 1
+    return parts_sent, len(parts)
+
 
 def _send_message(chat_id, message):
+    parts_sent, parts = _send_parts(chat_id, message)
+    return parts_sent == parts
+
+
+def _send_part(chat_id, message):
     if not GLOBAL_TG_BOT_TOKEN:
         logging.error("Token not set for Telegram bot. Cannot send notifications.")
         return False
@@ -24,25 +185,54 @@ def _send_message(chat_id, message):
         return False
 
     url = f"https://api.telegram.org/bot{GLOBAL_TG_BOT_TOKEN}/sendMessage"
-    params = {
+    payload = {
         'chat_id': chat_id,
         'parse_mode': 'Markdown',
         'text': message,
-        'disable_web_page_preview': 'true'
+        'disable_web_page_preview': True
     }
-    
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        
+    chat_bucket = _chat_bucket(chat_id)
+
+    for attempt in range(MAX_RETRIES + 1):
+        # the per-chat wait comes last so the spacing holds when the request leaves
+        _global_bucket.acquire()
+        chat_bucket.acquire()
+        start = time.monotonic()
+        with concurrency.get_limiter('telegram').slot() as slot:
+            try:
+                response = _get_session().post(url, json=payload, timeout=TIMEOUT)
+                if response.status_code == 429:
+                    slot.throttled()
+                elif response.status_code != 200:
+                    slot.failed()
+            except requests.exceptions.RequestException as e:
+                if isinstance(e, requests.exceptions.Timeout):
+                    slot.throttled()
+                else:
+                    slot.failed()
+                logging.error(f"Error (requestexception) while sending notification: {e}")
+                _record(False)
+                return False
+        latency = time.monotonic() - start
+
         if response.status_code == 200:
             logging.info(f"Notification sent to: {str(chat_id)[:4]}...")
+            _record(True, latency)
             return True
-        else:
-            logging.error(f"Error while sending notification to chat_id: {str(chat_id)[:4]}...: {response.status_code} - {response.text}")
-            return False
-            
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error (requestexception) while sending notification: {e}")
+
+        if response.status_code == 429:
+            retry_after = _retry_after(response)
+            with _stats_lock:
+                _stats['throttled'] += 1
+            metrics.incr('telegram.throttled')
+            # every thread sending to this chat waits, not only this one
+            chat_bucket.pause(retry_after)
+            if attempt < MAX_RETRIES and retry_after <= MAX_RETRY_AFTER_SECONDS:
+                logging.warning(f"Telegram rate limit for chat_id: {str(chat_id)[:4]}..., retrying in {retry_after}s")
+                continue
+
+        logging.error(f"Error while sending notification to chat_id: {str(chat_id)[:4]}...: {response.status_code} - {response.text}")
+        _record(False, latency)
         return False
 
 
@@ -59,5 +249,11 @@ def send_specific_telegram_notification(chat_id, message):
     logging.info(f"Sending specific notification: {str(chat_id)[:4]}...")
     return _send_message(chat_id, message)
 
+
+def send_specific_telegram_parts(chat_id, message, parts_sent: int = 0) -> Tuple[int, int]:
+    """Like send_specific_telegram_notification, resuming after parts_sent parts. Returns: (parts sent so far, parts)"""
+    logging.info(f"Sending specific notification: {str(chat_id)[:4]}...")
+    return _send_parts(chat_id, message, parts_sent)
+
 def get_global_chat_id():
     return GLOBAL_TG_CHAT_ID
\ No newline at end of file
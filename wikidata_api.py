@@ -1,41 +1,72 @@
+import json
+import time
+import random
 import requests
 import logging
+import concurrent.futures
+from collections import deque
+import concurrency
+import http_client
+import metrics
 from data_manager import get_id_from_cache, save_id_to_cache
 from telegram_notification import send_telegram_notification
 
+API_URL = 'https://www.wikidata.org/w/api.php'
+SPARQL_URL = 'https://query.wikidata.org/sparql'
+BATCH_RESOLVE_SIZE = 40
+
+SPARQL_CHUNK_SIZE = 50
+SPARQL_CHUNK_MIN = 5
+SPARQL_CHUNK_MAX = 300
+SPARQL_TARGET_SECONDS = 10
+SPARQL_TIMEOUT_SECONDS = 65  # the query service gives up after 60s
+SPARQL_THROTTLE_RETRIES = 3  # a throttled chunk is resent whole after a backoff, never split
+
+REVISIONS_CHUNK_SIZE = 50  # wbgetentities limit
+
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 
-def find_wikidata_id(DATABASE_FILE, person_name):
+def find_wikidata_id(DATABASE_FILE, person_name, cache=None):
 
-    cached_id = get_id_from_cache(DATABASE_FILE, person_name)
+    if cache is not None:
+        cached_id = cache.get(person_name)
+    else:
+        cached_id = get_id_from_cache(DATABASE_FILE, person_name)
     if cached_id:
         return cached_id
 
-    url = 'https://www.wikidata.org/w/api.php'
+    def remember(q_id):
+        if cache is not None:
+            cache.put(person_name, q_id)
+        else:
+            save_id_to_cache(DATABASE_FILE, person_name, q_id)
+
     params = {
         'action': 'wbsearchentities',
         'format': 'json',
         'language': 'it',
         'search': person_name,
-        'type': 'item'
+        'type': 'item',
+        'maxlag': 5
     }
     
     try:
-        response = requests.get(url, params=params, headers=HEADERS)
+        response = http_client.get(API_URL, params=params, headers=HEADERS,
+                                   limiter=concurrency.get_limiter('wikidata_api'), metric='wikidata.search')
         response.raise_for_status()
         data = response.json()
         
         for result in data.get('search', []):
             if 'description' in result and 'essere umano' in result['description'].lower():
                 q_id = result['id']
-                save_id_to_cache(DATABASE_FILE, person_name, q_id)
+                remember(q_id)
                 return q_id
 
         if data.get('search'):
             q_id = data['search'][0]['id']
-            save_id_to_cache(DATABASE_FILE, person_name, q_id)
+            remember(q_id)
             return q_id
             
     except requests.exceptions.RequestException as e:
@@ -43,54 +74,362 @@ def find_wikidata_id(DATABASE_FILE, person_name):
         send_telegram_notification(f"Error while searching data for '{person_name}': {e}")
         return -1 
     
+    metrics.incr('wikidata.search.not_found')
     logging.warning(f"Nessun ID Wikidata trovato per '{person_name}'")
     return None
 
-def get_person_data(q_ids):
-    results = {}
-    if not q_ids:
-        return {}
-    
-    q_ids_chunks = [q_ids[i:i + 50] for i in range(0, len(q_ids), 50)]
-    
-    for chunk in q_ids_chunks:
-        filter_values = ' '.join([f'wd:{q_id}' for q_id in chunk])
-        
+def find_wikidata_ids(DATABASE_FILE, person_names, cache=None):
+    """
+    Resolves many names with one SPARQL request per BATCH_RESOLVE_SIZE names,
+    matching the exact italian/english label or alias of a human (P31 = Q5).
+    When several humans share the name the one with the most sitelinks wins,
+    labels are preferred over aliases.
+    Returns: dict {name: q_id} for the names resolved (from cache or batch),
+    the others are left to find_wikidata_id.
+    """
+    resolved = {}
+    to_search = []
+    for name in person_names:
+        cached_id = cache.get(name) if cache is not None else get_id_from_cache(DATABASE_FILE, name)
+        if cached_id:
+            resolved[name] = cached_id
+        else:
+            to_search.append(name)
+    metrics.incr('resolution_cache.hits', len(resolved))
+    metrics.incr('resolution_cache.misses', len(to_search))
+
+    for i in range(0, len(to_search), BATCH_RESOLVE_SIZE):
+        chunk = to_search[i:i + BATCH_RESOLVE_SIZE]
+        literals = [json.dumps(name, ensure_ascii=False) for name in chunk]
+        values = ' '.join(f'{lit}@it {lit}@en' for lit in literals)
+
         query = f"""
-        SELECT ?person ?personLabel ?birthDate ?deathDate WHERE {{
-          VALUES ?person {{ {filter_values} }}
-          OPTIONAL {{ ?person wdt:P569 ?birthDate. }}
-          OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
-          SERVICE wikibase:label {{ bd:serviceParam wikibase:language "it,en". }}
+        SELECT ?label ?item ?rank ?sitelinks WHERE {{
+          VALUES ?label {{ {values} }}
+          {{ ?item rdfs:label ?label. BIND(1 AS ?rank) }}
+          UNION
+          {{ ?item skos:altLabel ?label. BIND(0 AS ?rank) }}
+          ?item wdt:P31 wd:Q5.
+          OPTIONAL {{ ?item wikibase:sitelinks ?sitelinks. }}
         }}
         """
-        
-        url = 'https://query.wikidata.org/sparql'
-        
+
         try:
-            response = requests.get(url, params={'query': query, 'format': 'json'}, headers=HEADERS)
+            response = http_client.get(SPARQL_URL, params={'query': query, 'format': 'json'}, headers=HEADERS,
+                                       limiter=concurrency.get_limiter('sparql'), metric='wikidata.sparql_resolve')
             response.raise_for_status()
             data = response.json()
-            
+            best = {}
             for item in data['results']['bindings']:
-                person_uri = item['person']['value']
-                q_id = person_uri.split('/')[-1]
-                person_label = item.get('personLabel', {}).get('value', 'Sconosciuto')
-                
-                birth_date = item.get('birthDate', {}).get('value')
-                death_date = item.get('deathDate', {}).get('value')
-                
-                death_info = death_date.split('T')[0] if death_date else None
-                
-                results[q_id] = {
-                    'nome': person_label,
-                    'data_di_nascita': birth_date.split('T')[0] if birth_date else None,
-                    'data_di_morte': death_info,
-                    'wikidata_url': person_uri
-                }
-                
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Error while contacting wikidata: {e}")
-            continue 
-            
-    return results
\ No newline at end of file
+                name = item['label']['value']
+                q_id = item['item']['value'].split('/')[-1]
+                score = (int(item['rank']['value']), int(item.get('sitelinks', {}).get('value', 0)))
+                if name not in best or score > best[name][0]:
+                    best[name] = (score, q_id)
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            logging.error(f"Error while resolving names in batch, falling back to single searches: {e}")
+            continue
+
+        metrics.incr('wikidata.batch_resolved', len(best))
+        for name in chunk:
+            if name in best:
+                q_id = best[name][1]
+                resolved[name] = q_id
+                if cache is not None:
+                    cache.put(name, q_id)
+                else:
+                    save_id_to_cache(DATABASE_FILE, name, q_id)
+
+    return resolved
+
+def _query_revisions_chunk(chunk):
+    params = {
+        'action': 'wbgetentities',
+        'format': 'json',
+        'props': 'info',
+        'ids': '|'.join(chunk),
+        'maxlag': 5
+    }
+    response = http_client.get(API_URL, params=params, headers=HEADERS,
+                               limiter=concurrency.get_limiter('wikidata_api'), metric='wikidata.revisions')
+    response.raise_for_status()
+    data = response.json()
+
+    revisions = {}
+    for q_id, entity in data.get('entities', {}).items():
+        if 'lastrevid' in entity:
+            revisions[q_id] = (entity['lastrevid'], entity.get('modified'))
+    return revisions
+
+
+def get_entity_revisions(q_ids):
+    """
+    Returns: dict {q_id: (lastrevid, modified)}, 50 entities per request.
+    IDs missing from the result (errors, deleted items) must be treated as changed.
+    """
+    q_ids = list(q_ids)
+    chunks = [q_ids[i:i + REVISIONS_CHUNK_SIZE] for i in range(0, len(q_ids), REVISIONS_CHUNK_SIZE)]
+    results = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency.get_limiter('wikidata_api').max_limit) as executor:
+        future_to_chunk = {executor.submit(_query_revisions_chunk, chunk): chunk for chunk in chunks}
+        for future in concurrent.futures.as_completed(future_to_chunk):
+            try:
+                results.update(future.result())
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logging.error(f"Error while reading revisions of {len(future_to_chunk[future])} entities: {e}")
+
+    return results
+
+
+def _claim_date(claims, prop):
+    """Date of the best ranked value of a time property, as the query service gives it for wdt: (YYYY-MM-DD)."""
+    statements = [statement for statement in claims.get(prop, [])
+                  if statement.get('rank') != 'deprecated' and statement['mainsnak'].get('snaktype') == 'value']
+    preferred = [statement for statement in statements if statement.get('rank') == 'preferred']
+    for statement in preferred or statements:
+        value = statement['mainsnak'].get('datavalue', {}).get('value', {})
+        if 'time' not in value:
+            continue
+        # '+1952-03-11T00:00:00Z', month and day are 00 when the precision is the year
+        year, month, day = value['time'].lstrip('+').split('T')[0].rsplit('-', 2)
+        return f"{year}-{'01' if month == '00' else month}-{'01' if day == '00' else day}"
+    return None
+
+
+def get_entities_data(q_ids):
+    """
+    Same data as get_person_data, read from the live items with wbgetentities.
+    Returns: ({q_id: person data}, {q_id: (lastrevid, modified)})
+    """
+    q_ids = list(q_ids)
+    results, revisions = {}, {}
+    for i in range(0, len(q_ids), REVISIONS_CHUNK_SIZE):
+        chunk = q_ids[i:i + REVISIONS_CHUNK_SIZE]
+        params = {
+            'action': 'wbgetentities',
+            'format': 'json',
+            'props': 'info|labels|claims',
+            'languages': 'it|en',
+            'ids': '|'.join(chunk),
+            'maxlag': 5
+        }
+        try:
+            response = http_client.get(API_URL, params=params, headers=HEADERS,
+                                       limiter=concurrency.get_limiter('wikidata_api'), metric='wikidata.entities')
+            response.raise_for_status()
+            entities = response.json().get('entities', {})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"Error while reading {len(chunk)} entities from wikidata: {e}")
+            continue
+
+        for q_id, entity in entities.items():
+            if 'missing' in entity or 'lastrevid' not in entity:
+                continue
+            labels = entity.get('labels', {})
+            label = labels.get('it', labels.get('en', {})).get('value', q_id)
+            claims = entity.get('claims', {})
+            results[q_id] = {
+                'nome': label,
+                'data_di_nascita': _claim_date(claims, 'P569'),
+                'data_di_morte': _claim_date(claims, 'P570'),
+                'wikidata_url': f"http://www.wikidata.org/entity/{q_id}",
+                'revisione': entity['lastrevid']
+            }
+            revisions[q_id] = (entity['lastrevid'], entity.get('modified'))
+    return results, revisions
+
+
+def revisions_reflected(revisions, person_data):
+    """
+    Keeps the revisions ({q_id: (lastrevid, modified)} from get_entity_revisions)
+    that the query service data (get_person_data, 'revisione' = schema:version)
+    already reflects. The query service lags behind live edits: storing a
+    revision it has not caught up with would mark the item as unchanged and
+    hide a death date added by that edit until the next one.
+    """
+    reflected = {q_id: revision for q_id, revision in revisions.items()
+                 if q_id in person_data and (person_data[q_id].get('revisione') or 0) >= revision[0]}
+    lagging = len([q_id for q_id in revisions if q_id in person_data]) - len(reflected)
+    if lagging:
+        metrics.incr('wikidata.sparql_lagging', lagging)
+        logging.info(f"{lagging} IDs not yet up to date on the query service, they will be read again")
+    return reflected
+
+
+def _query_person_chunk(chunk):
+    filter_values = ' '.join([f'wd:{q_id}' for q_id in chunk])
+
+    query = f"""
+    SELECT ?person ?personLabel ?birthDate ?deathDate ?version WHERE {{
+      VALUES ?person {{ {filter_values} }}
+      OPTIONAL {{ ?person schema:version ?version. }}
+      OPTIONAL {{ ?person wdt:P569 ?birthDate. }}
+      OPTIONAL {{ ?person wdt:P570 ?deathDate. }}
+      SERVICE wikibase:label {{ bd:serviceParam wikibase:language "it,en". }}
+    }}
+    """
+
+    started = time.monotonic()
+    # no retry at the HTTP level, get_person_data decides between splitting and resending
+    response = http_client.get(SPARQL_URL, params={'query': query, 'format': 'json'}, headers=HEADERS,
+                               timeout=(5, SPARQL_TIMEOUT_SECONDS), max_retries=0,
+                               limiter=concurrency.get_limiter('sparql'), metric='wikidata.sparql_person')
+    response.raise_for_status()
+    data = response.json()
+    elapsed = time.monotonic() - started
+
+    results = {}
+    for item in data['results']['bindings']:
+        person_uri = item['person']['value']
+        q_id = person_uri.split('/')[-1]
+        person_label = item.get('personLabel', {}).get('value', 'Sconosciuto')
+
+        birth_date = item.get('birthDate', {}).get('value')
+        death_date = item.get('deathDate', {}).get('value')
+
+        death_info = death_date.split('T')[0] if death_date else None
+        version = item.get('version', {}).get('value')
+
+        results[q_id] = {
+            'nome': person_label,
+            'data_di_nascita': birth_date.split('T')[0] if birth_date else None,
+            'data_di_morte': death_info,
+            'wikidata_url': person_uri,
+            'revisione': int(version) if version else None
+        }
+    return results, elapsed
+
+
+def _is_query_timeout(error):
+    """True for the failures a smaller chunk can fix: timeouts, query errors (500) and truncated answers."""
+    if isinstance(error, (requests.exceptions.Timeout, ValueError, KeyError)):
+        return True
+    response = getattr(error, 'response', None)
+    return isinstance(error, requests.exceptions.HTTPError) and response is not None and response.status_code == 500
+
+
+def _throttle_delay(error, attempt):
+    """Jittered exponential backoff, at least the Retry-After of a 429/503 answer."""
+    delay = random.uniform(0, min(http_client.BACKOFF_MAX_SECONDS, http_client.BACKOFF_BASE_SECONDS * 2 ** (attempt + 1)))
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            delay = max(delay, min(float(response.headers.get('Retry-After', 0)), http_client.BACKOFF_MAX_SECONDS))
+        except ValueError:
+            pass
+    return delay
+
+
+def get_person_data(q_ids):
+    """
+    Fetches label, birth and death date for every QID. Chunks run in
+    parallel up to the adaptive 'sparql' concurrency limit; the chunk size
+    grows while queries are fast and shrinks on slow ones. A chunk the query
+    service could not answer in time is split in half and retried until a
+    single QID fails on its own. A throttled chunk (429, 5xx other than 500,
+    connection errors) is not split: no chunk is sent during a backoff, then
+    it is resent whole, up to SPARQL_THROTTLE_RETRIES times.
+    """
+    results = {}
+    if not q_ids:
+        return {}
+
+    q_ids = list(q_ids)
+    position = 0
+    chunk_size = SPARQL_CHUNK_SIZE
+    retry_chunks = deque()  # (chunk, throttled attempts so far)
+    resume_at = 0.0
+
+    limiter = concurrency.get_limiter('sparql')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limiter.max_limit) as executor:
+        running = {}
+        while position < len(q_ids) or retry_chunks or running:
+            while (len(running) < limiter.current_limit() and (retry_chunks or position < len(q_ids))
+                   and time.monotonic() >= resume_at):
+                if retry_chunks:
+                    chunk, attempt = retry_chunks.popleft()
+                else:
+                    chunk, attempt = q_ids[position:position + chunk_size], 0
+                    position += len(chunk)
+                running[executor.submit(_query_person_chunk, chunk)] = (chunk, attempt)
+
+            if not running:
+                time.sleep(max(0.0, resume_at - time.monotonic()))
+                continue
+            wait = resume_at - time.monotonic()
+            done, _ = concurrent.futures.wait(running, timeout=wait if wait > 0 else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                chunk, attempt = running.pop(future)
+                try:
+                    chunk_results, elapsed = future.result()
+                except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+                    if not _is_query_timeout(e):
+                        if attempt < SPARQL_THROTTLE_RETRIES:
+                            delay = _throttle_delay(e, attempt)
+                            logging.warning(f"Wikidata query for {len(chunk)} IDs throttled ({e}), resending it in {delay:.0f}s")
+                            metrics.incr('wikidata.sparql_person.throttled')
+                            resume_at = max(resume_at, time.monotonic() + delay)
+                            retry_chunks.append((chunk, attempt + 1))
+                        else:
+                            logging.error(f"Error while contacting wikidata for {len(chunk)} IDs, giving up after {attempt + 1} attempts: {e}")
+                        continue
+
+                    chunk_size = max(SPARQL_CHUNK_MIN, chunk_size // 2)
+                    if len(chunk) > 1:
+                        half = len(chunk) // 2
+                        logging.warning(f"Wikidata query for {len(chunk)} IDs failed ({e}), retrying in two halves")
+                        retry_chunks.append((chunk[:half], 0))
+                        retry_chunks.append((chunk[half:], 0))
+                    else:
+                        logging.error(f"Error while contacting wikidata for {chunk[0]}: {e}")
+                    continue
+
+                results.update(chunk_results)
+                if elapsed < SPARQL_TARGET_SECONDS / 2:
+                    chunk_size = min(SPARQL_CHUNK_MAX, chunk_size + chunk_size // 2)
+                elif elapsed > SPARQL_TARGET_SECONDS:
+                    chunk_size = max(SPARQL_CHUNK_MIN, chunk_size // 2)
+
+    return results
+
+
+def get_changed_people_data(items, stored_revisions, new_names):
+    """
+    Downloads the data of the resolved people whose Wikidata item changed
+    since its stored revision (new names are always downloaded).
+    items: [(name, q_id)], stored_revisions: {q_id: lastrevid}
+    Returns: ({name: record for bulk_upsert_persons}, {q_id: (lastrevid, modified)} to save)
+    """
+    items = list(items)
+    q_ids_to_query = {q_id for _, q_id in items if q_id}
+    if not q_ids_to_query:
+        return {}, {}
+
+    # items not edited since their last update can't carry a new death date
+    revisions = get_entity_revisions(q_ids_to_query)
+    q_ids_of_new_names = {q_id for name, q_id in items if name in new_names}
+    unchanged = {q_id for q_id, (revision, _) in revisions.items()
+                 if stored_revisions.get(q_id) == revision} - q_ids_of_new_names
+    metrics.incr('people.unchanged_skipped', len(unchanged))
+    if unchanged:
+        logging.info(f"{len(unchanged)} IDs unchanged since the last check, skipping them.")
+        q_ids_to_query -= unchanged
+    if not q_ids_to_query:
+        return {}, {}
+
+    logging.info(f"Querying Wikidata for {len(q_ids_to_query)} IDs")
+    metrics.incr('people.refreshed', len(q_ids_to_query))
+    all_updated_data = get_person_data(list(q_ids_to_query))
+
+    records = {}
+    for name, q_id in items:
+        if q_id not in q_ids_to_query:
+            continue
+        data_to_save = {}
+        if q_id in all_updated_data:
+            data_to_save = dict(all_updated_data[q_id])
+            data_to_save['id_wikidata'] = q_id
+        records[name] = data_to_save
+    return records, revisions_reflected(revisions, all_updated_data)